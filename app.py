@@ -11,8 +11,8 @@ import matplotlib.pyplot as plt
 import PIL
 import h5py
 import numpy as np
-import os, base64
-from io import BytesIO
+import os
+import flask
 from scipy.stats import entropy
 
 import gym
@@ -24,16 +24,79 @@ app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
 
 server = app.server
 
-# Total training log
-log_data = pd.read_csv("baby-a3c/breakout-v4/log-model7-02-17-20-41.txt")
-log_data.columns = log_data.columns.str.replace(" ", "")
-
-
-# Load data into memory by default, otherwise delete 'driver='core'' to read from disk
-replays = h5py.File('static/model_rollouts_5.h5','r', driver='core')
-
-# list of epoch numbers we took (number * 500k is the number of frames trained at that point)
-snapshots = [1,19,30,40,50,60,70,80,90,100]
+# Per-callback wall time, bytes read from the store, response size and cache hits/misses, served as histograms on
+# /metrics (see visualize_atari/metrics.py). callbacks slower than $SLOW_CALLBACK_MS are logged, to $SLOW_CALLBACK_LOG
+# if set. installed before any callback is registered, so that all of them are measured. every server process keeps its
+# totals in static/metrics/ (or $METRICS_DIR), and /metrics serves their sum from any of them
+metrics = CallbackMetrics(slow_ms=float(os.environ['SLOW_CALLBACK_MS']) if 'SLOW_CALLBACK_MS' in os.environ else None,
+                          slow_log=os.environ.get('SLOW_CALLBACK_LOG'),
+                          shared_dir=os.environ.get('METRICS_DIR', 'static/metrics')).install(app)
+
+# Rollout store, read lazily from disk: callbacks only read the frames they slice, through a bounded block cache
+# (see visualize_atari/access.py), so the store does not have to fit in memory. if the store was exported to .npy
+# files (python visualize_atari/store.py export static/model_rollouts_5.h5 static/model_rollouts_5), it is
+# memory-mapped instead, and all server processes share one copy of it in the page cache. an export older than the
+# h5 file is ignored until it is exported again
+h5_path, export_dir = 'static/model_rollouts_5.h5', 'static/model_rollouts_5'
+use_export = os.path.isdir(export_dir) and (not os.path.exists(h5_path) or export_current(h5_path, export_dir))
+store_path = export_dir if use_export else h5_path
+replays = open_store(store_path, cache_bytes=512 << 20)
+
+# max points per trace of the zoomable timelines, which are drawn from level-of-detail pyramids (visualize_atari/lod.py)
+lod_points = 1000
+# max buckets of the 2x2 saliency squares along the gantt timelines (4 markers each), from the same pyramids
+region_points = 100
+# width in pixels of the line charts (plotly's default: their containers don't set one). their traces are downsampled
+# to about a point per pixel, so long episodes don't mean megabytes of JSON, and refined when zoomed in
+graph_px = 700
+
+# Runs, snapshots and episodes of the store, from the manifest written with it (see visualize_atari/store.py).
+# the dashboard shows one run: the one named by $DASHBOARD_RUN, or the store's first
+manifest = load_manifest(store_path)
+run = os.environ.get('DASHBOARD_RUN', sorted(manifest['runs'])[0])
+checkpoints = manifest['runs'][run]['checkpoints']
+
+# list of epoch numbers we took (number * 500k is the number of frames trained at that point). only checkpoints whose
+# first episode is complete and has saliency are shown: generate_data.py writes the manifest after its rollout stage too
+def viewable(checkpoint):
+    ep = checkpoint['episodes'].get('0')
+    return ep is not None and not ep['partial'] and all(k in ep['datasets'] for k in ['actor_sal', 'critic_sal'])
+snapshots = sorted(int(s) for s, ck in checkpoints.items() if viewable(ck))
+if not snapshots:
+    raise SystemExit('no checkpoint of run {} has saliency yet: run python generate_data.py saliency first'.format(run))
+
+# Total training log of the run: baby-a3c writes the snapshots of model <name> to models_<name>/ and its log to
+# log-<name>.txt next to them. $DASHBOARD_LOG overrides it
+log_path = os.environ.get('DASHBOARD_LOG', 'baby-a3c/breakout-v4/' + run.replace('models_', 'log-', 1) + '.txt')
+def load_log():
+    if not os.path.exists(log_path): # no training curve, rather than no dashboard
+        return pd.DataFrame({'frames': [], 'mean-epr': []})
+    log_data = pd.read_csv(log_path)
+    log_data.columns = log_data.columns.str.replace(" ", "")
+    return log_data
+
+# Helper funcs to get an episode of a snapshot from the store, and its manifest entry (datasets, stats)
+def episode(snapshot, ep=0):
+    return replays[episode_info(snapshot, ep)['path']]
+
+def episode_info(snapshot, ep=0):
+    return checkpoints[str(snapshot)]['episodes'][str(ep)]
+
+# snapshot shown by default in place of preferred, the nearest the run has
+def default_snapshot(preferred):
+    return min(snapshots, key=lambda s: abs(s - preferred))
+
+# Figures of the callbacks that only depend on their inputs and the store are memoized in memory and in a directory
+# shared by all server processes (see visualize_atari/cache.py). rewriting the store or its manifest invalidates them
+data_version = '{} {} {}'.format(store_path, run, os.path.getmtime(manifest_path(store_path) if os.path.exists(manifest_path(store_path)) else store_path))
+figures = FigureCache(max_bytes=256 << 20, disk_dir='static/figure_cache', version=data_version, disk_bytes=1 << 30)
+
+# Saliency overlays for the frame viewer, served from an LRU cache. prebuild them with
+# python -m visualize_atari.overlays static/model_rollouts_5.h5 static/overlays.h5 to skip rendering on first view.
+# prebuilt overlays of an older version of the h5 file are ignored until they are built again
+overlays_path = 'static/overlays.h5'
+use_prebuilt = os.path.exists(overlays_path) and (not os.path.exists(h5_path) or overlays_current(h5_path, overlays_path))
+overlays = OverlayCache(episode, prebuilt_path=overlays_path if use_prebuilt else None)
 
 # HTML Page layout
 app.layout = html.Div(children=[
@@ -101,12 +164,12 @@ app.layout = html.Div(children=[
                 dcc.Dropdown(
                     id='gantt-select1',
                     options=[{'label':x, 'value':x} for x in snapshots],
-                    value='90'
+                    value=default_snapshot(90)
                 ),
                 dcc.Dropdown(
                     id='gantt-select2',
                     options=[{'label':x, 'value':x} for x in snapshots],
-                    value='60'
+                    value=default_snapshot(60)
                 ),], style = {'padding-bottom':'15em'}),
             
         ], style = {'position':'absolute','margin-left':'80em','width':'6em','border':'1px solid black', 'display':'inline-block'}),
@@ -152,10 +215,10 @@ app.layout = html.Div(children=[
         html.Div([
             html.Div(id='snapshot-val'),
             dcc.Slider(id='snapshot-slider',
-                   min = 1,
-                   max = 100,
-                   value = 50,
-                   marks = {i: str(i) for i in [1,10,19,30,40,50,60,70,80,90,100]},
+                   min = snapshots[0],
+                   max = snapshots[-1],
+                   value = default_snapshot(50),
+                   marks = {i: str(i) for i in snapshots},
                    step = None
                
                   )
@@ -190,7 +253,7 @@ def update_frame_slider(input_value):
     [Input(component_id='snapshot-slider', component_property='value')]
 )
 def update_snapshot_slider(snapshot):
-    length = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0/logits'].shape[0]
+    length = episode_info(snapshot)['stats']['frames']
     d = {i: str(i) for i in range(0, 3000, 100)}
     for k in d:
         if k > length:
@@ -229,16 +292,13 @@ def update_link_snapshot(entropy_click, candle_click, gantt_click1, gantt_click2
         return (entropy_click['points'][0]['x'])
     if candle_click:
         return (candle_click['points'][0]['x'])
-    print(gantt_click1, gantt_click_memory)
     # Prevent first gantt's clicks from re-updating if it didn't change    
     if gantt_click1 and myround(gantt_click1['points'][0]['x']) != gantt_click_memory:
-        print(gantt_epoch1)
         return gantt_epoch1
     if gantt_click2:
-        print(gantt_epoch2)
         return gantt_epoch2
     
-    return 50
+    return default_snapshot(50) # on page load: the slider's initial snapshot, which the run is sure to have
 
 # Round to multiple of 5
 def myround(x, base=5):
@@ -285,17 +345,21 @@ def update_link_frame(regions_click, actions_click, trajectory_click, bars_click
     if gantt_click1 and myround(gantt_click1['points'][0]['x']) != gantt_click_memory:
         return myround((gantt_click1['points'][0]['x']))
     if gantt_click2:
-        print(gantt_click2)
         return myround((gantt_click2['points'][0]['x']))
 
     return 50
 
 # Control rewards candlestick chart (row 1, col 1)
+# Input is 'null' as it stays static: the figure is built once, see static_figures below
 @app.callback(
     Output(component_id='rewards-candlestick', component_property='figure'),
     [Input(component_id='null', component_property='children')]
 )
 def update_rewards_candlestick(start):
+    return static_figures.get('rewards-candlestick')
+
+def rewards_candlestick_figure():
+    log_data = load_log() # reread, as training may have appended to it
     # Get data in increments of 40 (less noise)
     epr_xrange = (log_data['frames']/500e3).values[::40]
     epr_vals = log_data['mean-epr'].values[::40]
@@ -311,15 +375,17 @@ def update_rewards_candlestick(start):
                     name = 'Mean EPR')
     data = [trace]
     
-    # Also accumulate total saliency per episode for both types
+    # Also accumulate total saliency per episode for both types, from the manifest's stats when it has them
     saliency_toplevel = []
     for s in snapshots:
-        print(s)
-        history = replays['models_model7-02-17-20-41/model.'+str(s)+'.tar/history/0']
-        actor_frames, critic_frames = history['actor_sal'].value, history['critic_sal'].value
-        actor_tot_perframe = actor_frames.sum((1,2)).sum()/actor_frames.shape[0]
-
-        critic_tot_perframe = critic_frames.sum((1,2)).sum()/critic_frames.shape[0]
+        stats = episode_info(s)['stats']
+        if 'actor_tot_mean' in stats and 'critic_tot_mean' in stats:
+            saliency_toplevel.append([stats['actor_tot_mean'], stats['critic_tot_mean']])
+            continue
+        agg = load_aggregates(episode(s))
+        actor_tot_perframe = agg['actor_tot'].sum()/agg['actor_tot'].shape[0]
+
+        critic_tot_perframe = agg['critic_tot'].sum()/agg['critic_tot'].shape[0]
         
         saliency_toplevel.append([actor_tot_perframe, critic_tot_perframe])
     
@@ -385,15 +451,25 @@ def update_rewards_candlestick(start):
 # Input is 'null' as it stays static 
 @app.callback(
     Output(component_id='all-cum-rewards', component_property='figure'),
-    [Input(component_id='null', component_property='children')]
+    [Input(component_id='null', component_property='children'),
+     Input(component_id='all-cum-rewards', component_property='relayoutData')] # refine the curves on zoom
 )
-def update_all_cum_rewards(null):
+def update_all_cum_rewards(null, relayout):
+    zoom = visible_range(relayout)
+    return static_figures.get('all-cum-rewards') if zoom is None else zoomed_cum_rewards_figure(*zoom)
+
+@figures.memoize
+def zoomed_cum_rewards_figure(lower, upper):
+    return all_cum_rewards_figure(lower, upper)
+
+def all_cum_rewards_figure(lower=None, upper=None):
     data = []
     for s in snapshots: 
-        rewards = replays['models_model7-02-17-20-41/model.'+str(s)+'.tar/history/0/reward'].value
+        # the curve thinned to about a point per pixel of the visible range
+        x, cum_rewards = load_timeline(episode(s), 'cum_reward').line(lower, upper, graph_px)
         reward_trace = dict(
-            y = np.cumsum(rewards),
-            x = list(range(0, rewards.shape[0])),
+            y = cum_rewards,
+            x = x,
             name = f'Epoch {s}',
             line = dict(width = 3)
         )
@@ -421,9 +497,12 @@ def update_all_cum_rewards(null):
     [Input(component_id='null', component_property='children')]
 )
 def update_actions_entropy(null):
+    return static_figures.get('action-entropy')
+
+def actions_entropy_figure():
     return go.Figure() # turn off 
     # Get list of available snapshots
-    iterations = sorted([int(x.split('.')[1]) for x in list(replays['models_model7-02-17-20-41'].keys())])
+    iterations = snapshots
     y_data = []
     ep_lengths = {}
     x_range = []
@@ -433,7 +512,7 @@ def update_actions_entropy(null):
     # For each iteration, get logits and scale on x-axis with respect to length of episode
     # Logits are converted to moving averages of window size 10
     for i in iterations:
-        softmax_logits = replays['models_model7-02-17-20-41/model.'+str(i)+'.tar/history/0/outs'].value
+        softmax_logits = episode(i)['outs'][()]
         y_data.append(softmax_logits)
         ep_lengths[i] = len(softmax_logits)
         x_range.append(10*np.arange(0, (len(softmax_logits)/avg_len)))
@@ -496,17 +575,22 @@ def update_actions_entropy(null):
 # Control actions plot of stacked logits and cumulative reward per episode (row 1, column 4)
 @app.callback(
     Output(component_id='actions', component_property='figure'),
-    [Input(component_id='snapshot-slider', component_property='value')]
+    [Input(component_id='snapshot-slider', component_property='value'),
+     Input(component_id='actions', component_property='relayoutData')] # refine the level of detail on zoom
 )
-def update_actions(snapshot):
-    softmax_logits = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0/outs'].value
+@figures.memoize
+def update_actions(snapshot, relayout):
+    history = episode(snapshot)
+    lower, upper = visible_range(relayout) or (None, None)
     traces = []
     actions = ['NOOP', 'FIRE', 'RIGHT', 'LEFT']
-    # Just plot each logit for each frame
+    # Plot the mean of each logit over buckets of frames, about a bucket per pixel of the visible range (the stacked
+    # traces have to share their x values, so they are averaged rather than thinned)
+    x, _, _, softmax_logits = load_timeline(history, 'outs').view(lower, upper, graph_px)
     for a in range(softmax_logits.shape[1]):
         trace = dict(
-        x = list(range(0, softmax_logits.shape[0])),
-        y = softmax_logits[:, a],
+        x = x,
+        y = compact(softmax_logits[:, a]),
         hoverinfo = 'x+y',
         mode = 'lines',
         line = dict(width=0.5),
@@ -515,11 +599,11 @@ def update_actions(snapshot):
     )
         traces.append(trace) 
     
-    # Also plot cumulative rewards by frame
-    rewards = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0/reward'].value
+    # Also plot cumulative rewards by frame (the max of a bucket is its last value), thinned to about a point per pixel
+    x, cum_rewards = load_timeline(history, 'cum_reward').line(lower, upper, graph_px)
     reward_trace = dict(
-        y = np.cumsum(rewards),
-        x = list(range(0, softmax_logits.shape[0])),
+        y = cum_rewards,
+        x = x,
         name = 'Ep Reward',
         yaxis="y2",
         line = dict(width = 3)
@@ -546,14 +630,6 @@ def update_actions(snapshot):
     figure = go.Figure(data = traces, layout= layout)
     return figure
 
-# Function from Greydanus to upscale saliency values into visible blots of blue/red
-def saliency_on_frame_abbr(S, frame, fudge_factor, sigma = 0, channel = 0):
-    S = fudge_factor * S / S.max()
-    I = frame.astype('uint16')
-    I[35:195,:,channel] += S.astype('uint16')
-    I = I.clip(1,255).astype('uint8')
-    return I
-
 # Control frame display (row 2, col 1)
 @app.callback(
     Output(component_id='screen-ins', component_property='src'),
@@ -561,31 +637,16 @@ def saliency_on_frame_abbr(S, frame, fudge_factor, sigma = 0, channel = 0):
      Input('snapshot-slider', 'value')]
 )
 def update_frame_in_slider(frame, snapshot):
-    print('frame update')
-    # fetch frame based on snapshot and frame
-    frame = int(frame/5)
-    ins = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0/ins'].value
-    img = ins.copy()
-    history = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0']
-    # Get appropriate saliency values
-    if frame > len(ins):
-        img = np.zeros((210,160,3))
-        actor = img.copy(); critic = img.copy()
-    else: 
-        img = img[frame]
-        actor_frames = history['actor_sal'].value
-        critic_frames = history['critic_sal'].value
-        actor = actor_frames[frame]; critic=critic_frames[frame]
-    # Overlay saliency on frame
-    img = saliency_on_frame_abbr(actor, img, 500, 0, 2)
-    img = saliency_on_frame_abbr(critic, img, 500, 0 , 0)
-    
-    # Save as base64 string
-    buffer = BytesIO()
-    plt.imsave(buffer, img)
-    img_str = base64.b64encode(buffer.getvalue()).decode()
-    
-    return 'data:image/png;base64,{}'.format(img_str)
+    # encoded overlay of the stored frame (5 frame increments), from the overlay cache
+    return overlays.get(snapshot, 0, int(frame/5))
+
+# Helper func to get the x-axis range a graph is zoomed to from its relayoutData, None if not zoomed
+def visible_range(relayout):
+    if relayout and 'xaxis.range[0]' in relayout:
+        return relayout['xaxis.range[0]'], relayout['xaxis.range[1]']
+    if relayout and 'xaxis.range' in relayout:
+        return tuple(relayout['xaxis.range'])
+    return None
 
 # Helper func to fetch appropriate layout parameters for color, size, and border for an array of actions (0,1,2,3,2 etc) for 'gantt' plots
 def actions_to_marker(actions):
@@ -597,7 +658,6 @@ def actions_to_marker(actions):
 # Give a snapshot number and object for selected data in the parallel coords plot below
 # also take last arg to correct for zooming scale
 def gantt_figures(snapshot, parallelSelectedData, range_bounds=None):
-    ymid, xmid = 80, 80 # size in pixels of midpoints of saliency frames
     sal_thresh = 0.5 # threshold for selecting saliency as percentage of max saliency in frame
     action_thresh = 0.7 # threshold for selecting actions with softmax val greater than threshold
     
@@ -605,48 +665,37 @@ def gantt_figures(snapshot, parallelSelectedData, range_bounds=None):
     # This version selects frames where the *regional* saliency is greater than some threshold of the max *regional* saliency for the episode, and values are max-normalized by region
     def chart_data(snapshot):
         # Get data
-        history1 = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0']
-        rewards1 = history1['reward'].value
-        outs = history1['outs'].value
-        critic_sal = history1['critic_sal'].value
-        lower, upper = 0, len(rewards1)
+        history1 = episode(snapshot)
+        lower, upper = 0, len(history1['reward'])
 
         # Subset data if there are range bounds (due to zooming)
         if range_bounds:
-            lower = int(range_bounds[0])
-            upper = int(range_bounds[1])
-            rewards1 = rewards1[lower:upper]
-            outs = outs[lower:upper]
-            critic_sal = critic_sal[lower//5:upper//5]
+            lower = max(int(range_bounds[0]), 0)
+            upper = min(int(range_bounds[1]), upper)
+        # Rewards and action probabilities at the level of detail of the visible range: the max of every bucket of frames,
+        # so single-frame rewards and confident actions stay visible (one bucket per frame when zoomed in)
+        reward_x, _, rewards1, _ = load_timeline(history1, 'reward').view(lower, upper, lod_points)
+        _, _, outs, _ = load_timeline(history1, 'outs').view(lower, upper, lod_points)
         
         # subset actions that meet threshold 
         actions1ix = np.where(np.max(outs, axis = 1) > action_thresh)
         actions1types = np.argmax(outs[actions1ix], axis=1)
 
-        # divide saliency into regions
-        csaliency1 = critic_sal
-        csaliency1regions = np.array([csaliency1[:, :ymid, :xmid], csaliency1[:, :ymid, xmid:], csaliency1[:, ymid:, :xmid], csaliency1[:, ymid:, xmid:]])
-
-        csaliency1regions_maxs = [region.sum((1,2)).max() for region in csaliency1regions]
+        # Saliency summed by quadrant (see visualize_atari/regions.py), as the max of every bucket of scored frames of the
+        # visible range: one bucket per scored frame when zoomed in, at most region_points buckets otherwise
+        regions1 = load_timeline(history1, 'critic_regions')
+        region_x, _, critic_regions, _ = regions1.view(lower, upper, region_points)
+        span = regions1.levels[regions1.level(lower, upper, region_points)][0] * regions1.stride # frames per bucket
+        csaliency1regions_maxs = np.asarray(regions1.levels[-1][1][:, 1]).max(0) # of the whole episode, from the top level
 
-        # select frames where at least one of the saliency regions meet threshold for that region
-        csaliency1ix = np.where((csaliency1regions[0].sum((1,2)) > sal_thresh*csaliency1regions_maxs[0]) | 
-                                (csaliency1regions[1].sum((1,2)) > sal_thresh*csaliency1regions_maxs[1]) |
-                                (csaliency1regions[2].sum((1,2)) > sal_thresh*csaliency1regions_maxs[2]) |
-                                (csaliency1regions[3].sum((1,2)) > sal_thresh*csaliency1regions_maxs[3]))
-        
-        # Aggregate and reshape
-        csaliency1frames = csaliency1regions[:, csaliency1ix]
-        csaliency1frames = csaliency1frames.sum((3,4))
-        csaliency1frames = np.squeeze(csaliency1frames)
-        csaliency1frames = np.swapaxes(csaliency1frames, 0, 1)
+        # select buckets where at least one of the saliency regions meet threshold for that region
+        csaliency1ix = np.where((critic_regions > sal_thresh*csaliency1regions_maxs).any(1))
         
         # Normalize by region max
-        for region_ix in range(csaliency1frames.shape[1]):
-            csaliency1frames[:, region_ix] /= csaliency1regions_maxs[region_ix]
+        csaliency1frames = compact(critic_regions[csaliency1ix] / csaliency1regions_maxs)
         
-        # At this point, csaliency1ix is an array of frame numbers and csaliency1frames is accumulated saliency values by region
-        # The latter has shape N x 4, where N is the number of frames found that meet threshold and 4 is the number of regions
+        # At this point, region_x[csaliency1ix] are the first frames of the buckets and csaliency1frames is accumulated saliency values by region
+        # The latter has shape N x 4, where N is the number of buckets found that meet threshold and 4 is the number of regions
       
 
 
@@ -672,14 +721,13 @@ def gantt_figures(snapshot, parallelSelectedData, range_bounds=None):
     
         # convert n x n_regions array of saliency values to traces that look like the 2x2 saliency grids along a time line
         # example: we pass in n x [1,2,3,4] as values, where 1,2,3,4 are total saliency values of top left, top right, bot left, bot right regions
-        def plot_region_dots(region_vals, region_ix):
+        def plot_region_dots(region_vals, region_ix, width):
             xvals, selPoints = [], []
             yvals = np.tile(np.array([1,1,0,0]), len(region_vals))
             opacities = ['rgba(200, 68, 68,'+ str(i) + ')' for i in region_vals.flatten()]
-            width = int(0.024 * len(rewards1)) # scale saliency marks to what user currently sees (to accoutn for zooming)
             
-            for i, ix in enumerate(region_ix[0]):
-                xvals += [ix*5, ix*5 + width, ix*5, ix*5 + width]
+            for i, x in enumerate(region_x[region_ix]):
+                xvals += [x, x + width, x, x + width]
 
                 # Select points if they were highlighted in frame range specified by dimension 0 of parallel coords plot
                 # Needed to parse through format of the event callback (was absolutely monstrous)
@@ -691,20 +739,21 @@ def gantt_figures(snapshot, parallelSelectedData, range_bounds=None):
                                     if type(constraint_objs[0][0]) == list:
                                         constraint_objs = constraint_objs[0]
                                     for c in filter(lambda x: x != None, constraint_objs):
-                                        lower = c[0]
-                                        upper = c[1]
+                                        c_lo = c[0]
+                                        c_hi = c[1]
                                         
-                                        if ix >= lower//5 and ix <= upper//5:
+                                        if x + span > c_lo and x <= c_hi: # the bucket overlaps the selected frames
                                             selPoints += [4*i, 4*i+1, 4*i+2, 4*i+3] # add indices of selected data
             # Return data with some styling
             return xvals, yvals, dict(color= opacities, size = 14, line = dict(width = 1), symbol = 'square'), selPoints
     
         
-        # Collect data from above function 
-        t1infox, t1infoy, markers, selectedpointsInfo = plot_region_dots(csaliency1frames, csaliency1ix)
+        # Collect data from above function, scaling saliency marks to what user currently sees (to account for zooming)
+        width = int(0.024 * (upper - lower))
+        t1infox, t1infoy, markers, selectedpointsInfo = plot_region_dots(csaliency1frames, csaliency1ix, width)
 
         # Return all data for 'gantt' plots: rewards, actions, and saliency boxes
-        return (np.array(t1infox) + lower, t1infoy, markers, selectedpointsInfo), (list(range(lower, upper)), rewards1), (actions1ix[0] + lower, rewards1[actions1ix], actions_to_marker(actions1types))
+        return (t1infox, t1infoy, markers, selectedpointsInfo), (reward_x, rewards1), (reward_x[actions1ix], rewards1[actions1ix], actions_to_marker(actions1types))
 
     # Get saliency, rewards, and actions data formatted to put into a chart
     trace1sal, trace1rewards, trace1actions = chart_data(snapshot)
@@ -799,18 +848,13 @@ def gantt_figures(snapshot, parallelSelectedData, range_bounds=None):
 )
 def update_gantts(snapshot1, snapshot2, parallelSelectedData, relayout1, relayout2):
     if not snapshot1: # default values on page load
-        snapshot1 = 90
+        snapshot1 = default_snapshot(90)
     if not snapshot2:
-        snapshot2 = 60
-
-    range_bounds, range_bounds2 = None, None
+        snapshot2 = default_snapshot(60)
 
     # If zoomed, receive a callback to properly scale the 2x2 saliency marks
     # fetch x-axis range bounds from each callback
-    if relayout1 and 'xaxis.range[0]' in relayout1:
-        range_bounds = [relayout1['xaxis.range[0]'], relayout1['xaxis.range[1]']]
-    if relayout2 and 'xaxis.range[0]' in relayout2:
-        range_bounds2 = [relayout2['xaxis.range[0]'], relayout2['xaxis.range[1]']]
+    range_bounds, range_bounds2 = visible_range(relayout1), visible_range(relayout2)
     
     fig1 = gantt_figures(snapshot1, parallelSelectedData, range_bounds)
     fig2 = gantt_figures(snapshot2, parallelSelectedData, range_bounds2)
@@ -823,33 +867,20 @@ def update_gantts(snapshot1, snapshot2, parallelSelectedData, relayout1, relayou
     [Input(component_id='gantt-select1', component_property='value'),
     Input(component_id='gantt-select2', component_property='value')],
 )
+@figures.memoize
 def update_parallel_sal(snapshot1, snapshot2):
-    ymid, xmid = 80, 80 # pixel lengths to middle of frame
     sal_thresh = 0.5 # threshold for selecting saliency as percentage of max saliency in frame
     
     # This version selects frames where the *regional* saliency is greater than some threshold of the max *regional* saliency for the episode, and values are max-normalized by region
     # Same as chart_data in gantt functions
     def chart_data(snapshot):
-        history1 = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0']
-        rewards1 = history1['reward'].value
+        history1 = episode(snapshot)
+        critic_regions = load_aggregates(history1)['critic_regions']
+        csaliency1regions_maxs = critic_regions.max(0)
 
-        csaliency1 = history1['critic_sal'].value
-        csaliency1regions = np.array([csaliency1[:, :ymid, :xmid], csaliency1[:, :ymid, xmid:], csaliency1[:, ymid:, :xmid], csaliency1[:, ymid:, xmid:]])
-
-        csaliency1regions_maxs = [region.sum((1,2)).max() for region in csaliency1regions]
-
-        csaliency1ix = np.where((csaliency1regions[0].sum((1,2)) > sal_thresh*csaliency1regions_maxs[0]) | 
-                                (csaliency1regions[1].sum((1,2)) > sal_thresh*csaliency1regions_maxs[1]) |
-                                (csaliency1regions[2].sum((1,2)) > sal_thresh*csaliency1regions_maxs[2]) |
-                                (csaliency1regions[3].sum((1,2)) > sal_thresh*csaliency1regions_maxs[3]))
-        
-        csaliency1frames = csaliency1regions[:, csaliency1ix]
-        csaliency1frames = csaliency1frames.sum((3,4))
-        csaliency1frames = np.squeeze(csaliency1frames)
-        csaliency1frames = np.swapaxes(csaliency1frames, 0, 1)
+        csaliency1ix = np.where((critic_regions > sal_thresh*csaliency1regions_maxs).any(1))
         
-        for region_ix in range(csaliency1frames.shape[1]):
-            csaliency1frames[:, region_ix] /= csaliency1regions_maxs[region_ix]
+        csaliency1frames = critic_regions[csaliency1ix] / csaliency1regions_maxs
             
         return csaliency1ix[0]*5, csaliency1frames
     
@@ -926,24 +957,14 @@ def update_parallel_sal(snapshot1, snapshot2):
     Output(component_id='regions-subplots', component_property='figure'),
     [Input(component_id='snapshot-slider', component_property='value')]
 )
+@figures.memoize
 def update_regions_plots(snapshot):    
-    ymid, xmid = 80, 80
     window_length = 10
 
-    # Get data
-    history = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0']
-    actor_frames = history['actor_sal'].value
-    critic_frames = history['critic_sal'].value
-    
-    # Sum every frame
-    actor_tot = actor_frames.sum((1,2))
-    critic_tot = critic_frames.sum((1,2))
-   
-    # Divide frames into regions
-    targets = [(actor_frames[:, :ymid, :xmid], critic_frames[:, :ymid, :xmid]),
-               (actor_frames[:, :ymid, xmid:], critic_frames[:, :ymid, xmid:]),
-               (actor_frames[:, ymid:, :xmid], critic_frames[:, ymid:, :xmid]),
-               (actor_frames[:, ymid:, xmid:], critic_frames[:, ymid:, xmid:])]
+    # Get data: per-frame saliency sums, in total and by quarter region (precomputed, see visualize_atari/regions.py)
+    agg = load_aggregates(episode(snapshot))
+    actor_tot, critic_tot = agg['actor_tot'], agg['critic_tot']
+    targets = [(agg['actor_regions'][:, i], agg['critic_regions'][:, i]) for i in range(4)]
     # intensity defined by sum of values in frame region divided by sum of total values of full frame
     
     trace_labels = ['TopLeft', 'TopRight', 'BotLeft', 'BotRight']
@@ -953,10 +974,10 @@ def update_regions_plots(snapshot):
     a_ubounds, a_lbounds, c_ubounds, c_lbounds = [],[],[],[]
     for i in range(4):
         # Change indexing since saliency is only recorded every 5 frames
-        xrange = list(range(0, actor_frames.shape[0] * 5, 5))
+        xrange = list(range(0, actor_tot.shape[0] * 5, 5))
 
         # Get moving averages and moving mins/maxs of window_length (default 10)
-        data = pd.Series((targets[i][0]).sum((1,2))/actor_tot).rolling(window=window_length)
+        data = pd.Series(targets[i][0]/actor_tot).rolling(window=window_length)
         mavg = data.mean()
         lowerbound = data.min()
         upperbound = data.max()
@@ -996,7 +1017,7 @@ def update_regions_plots(snapshot):
     # Do same as above but fro critic saliency
     for i in range(4):
 
-        data = pd.Series((targets[i][1]).sum((1,2))/critic_tot).rolling(window=window_length)
+        data = pd.Series(targets[i][1]/critic_tot).rolling(window=window_length)
         mavg = data.mean()
         lowerbound = data.min()
         upperbound = data.max()
@@ -1073,21 +1094,12 @@ def update_regions_plots(snapshot):
     Output(component_id='regions_bars', component_property='figure'),
     [Input(component_id='snapshot-slider', component_property='value')]
 )
+@figures.memoize
 def update_regions_bars(snapshot):
-    ymid, xmid = 80, 80
-
     # Get data in same manner as for the region subplots
-    history = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0']
-    actor_frames = history['actor_sal'].value
-    critic_frames = history['critic_sal'].value
-    
-    actor_tot = actor_frames.sum((1,2))
-    critic_tot = critic_frames.sum((1,2))
-    
-    targets = [(actor_frames[:, :ymid, :xmid], critic_frames[:, :ymid, :xmid]),
-               (actor_frames[:, :ymid, xmid:], critic_frames[:, :ymid, xmid:]),
-               (actor_frames[:, ymid:, :xmid], critic_frames[:, ymid:, :xmid]),
-               (actor_frames[:, ymid:, xmid:], critic_frames[:, ymid:, xmid:])]
+    agg = load_aggregates(episode(snapshot))
+    actor_tot, critic_tot = agg['actor_tot'], agg['critic_tot']
+    targets = [(agg['actor_regions'][:, i], agg['critic_regions'][:, i]) for i in range(4)]
     # intensity defined by sum of values in frame region divided by sum of total values of full frame
     
     trace_labels = ['TopLeft', 'TopRight', 'BotLeft', 'BotRight']
@@ -1095,11 +1107,11 @@ def update_regions_bars(snapshot):
     # color intensity calculated as fraction of saliency intensity for the whole frame
     z = []
     for i, label in enumerate(trace_labels):
-        z.append((targets[i][0]).sum((1,2)) / actor_tot)
+        z.append(targets[i][0] / actor_tot)
     
     heatmap = go.Heatmap(
         z = z,
-        x = list(range(0, actor_frames.shape[0]*5, 5)),
+        x = list(range(0, actor_tot.shape[0]*5, 5)),
         y = trace_labels,
         colorscale = 'Viridis',
         yaxis='y2')
@@ -1121,9 +1133,10 @@ def update_regions_bars(snapshot):
     Output(component_id='trajectory', component_property='figure'),
     [Input(component_id='snapshot-slider', component_property='value')]
 )
+@figures.memoize
 def update_trajectory(snapshot):
-    history = replays['models_model7-02-17-20-41/model.'+str(snapshot)+'.tar/history/0']
-    softmax_logits = history['outs'].value
+    history = episode(snapshot)
+    softmax_logits = history['outs'][()]
     actions = np.argmax(softmax_logits, axis=1)
     positions = np.zeros(softmax_logits.shape[0]+1)
     # movements are in pixels, but approximations, because position doesn't seem fully deterministic
@@ -1140,16 +1153,16 @@ def update_trajectory(snapshot):
         x = list(range(positions.shape[0]))[::10],
         y = positions[::10],
     )
-    actor_frames, critic_frames = history['actor_sal'].value, history['critic_sal'].value
+    agg = load_aggregates(history)
     
-    actor_tot = actor_frames.sum((1,2))
+    actor_tot = agg['actor_tot']
 
-    critic_tot = critic_frames.sum((1,2))
+    critic_tot = agg['critic_tot']
     
     actor_sum, critic_sum = actor_tot.max() , critic_tot.max()
 
     actor_bars = go.Bar(
-        x = list(range(0, actor_frames.shape[0]*5, 5)),
+        x = list(range(0, actor_tot.shape[0]*5, 5)),
         y = actor_tot/actor_sum,
         name = 'A Sal',
         yaxis = 'y2',
@@ -1159,7 +1172,7 @@ def update_trajectory(snapshot):
         hoverinfo = 'none'
     )
     critic_bars = go.Bar(
-        x = list(range(0, actor_frames.shape[0]*5, 5)),
+        x = list(range(0, actor_tot.shape[0]*5, 5)),
         y = critic_tot/critic_sum,
         name = 'C Sal',
         yaxis='y2',
@@ -1191,5 +1204,34 @@ def update_trajectory(snapshot):
     return fig
     
 
+# Figures that only depend on the training log and the store, built once at startup (in parallel) and served from
+# memory. they are pickled to static/, so restarts and the other server processes load them instead. they are rebuilt
+# when the training log changes; the store (like its manifest, snapshots and sliders above) is only read at startup,
+# so the server has to be restarted to show a rewritten store, and then rebuilds them
+static_figures = StaticFigures({'rewards-candlestick': rewards_candlestick_figure,
+                                'all-cum-rewards': all_cum_rewards_figure,
+                                'action-entropy': actions_entropy_figure},
+                               files=[log_path, manifest_path(store_path) if os.path.exists(manifest_path(store_path)) else store_path],
+                               path='static/static_figures-{}.pkl'.format(run), watch=[log_path]).build()
+
+# Called by each server worker after it is forked from the process that imported this module (see gunicorn.conf.py):
+# everything loaded above is shared copy-on-write, only the HDF5 file handles have to be reopened
+def after_fork():
+    replays.reopen()
+    overlays.reopen()
+
+# Health check for load balancers and process managers: 200 if this worker can read the store, 503 otherwise
+@server.route('/health')
+def health():
+    status = {'pid': os.getpid(), 'store': store_path, 'run': run, 'snapshots': len(snapshots)}
+    try:
+        status['frames'] = int(episode(snapshots[0])['reward'].shape[0])
+    except Exception as e:
+        status.update(status='error', error=str(e))
+        return flask.jsonify(status), 503
+    status['status'] = 'ok'
+    return flask.jsonify(status)
+
 if __name__ == '__main__':
-    app.run_server(debug=True, host='0.0.0.0')
+    # development server. for serving a team use gunicorn (see gunicorn.conf.py): gunicorn -c gunicorn.conf.py app:server
+    app.run_server(debug=os.environ.get('DASH_DEBUG', '1') == '1', host='0.0.0.0')
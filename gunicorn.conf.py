@@ -0,0 +1,21 @@
+# Production server for the dashboard: gunicorn -c gunicorn.conf.py app:server
+# app.py is imported once in the master process (preload_app), which loads the manifest, opens the store and builds the
+# static figures, then forks the workers: they share all of it copy-on-write (or, for a store exported to .npy files,
+# through the page cache) and only reopen their HDF5 file handles. every worker serves requests on several threads,
+# so one slow callback does not hold up everyone else. settings can be overridden from the environment
+
+import os, multiprocessing
+
+bind = '0.0.0.0:' + os.environ.get('PORT', '8050')
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 8)))
+threads = int(os.environ.get('THREADS', 4))
+worker_class = 'gthread'
+preload_app = True
+timeout = int(os.environ.get('TIMEOUT', 120)) # the first render of a big figure can take a while
+max_requests = int(os.environ.get('MAX_REQUESTS', 0)) # recycle workers after this many requests (0: never)
+max_requests_jitter = max_requests // 10
+accesslog = os.environ.get('ACCESS_LOG', None) # '-' for stdout
+
+def post_fork(server, worker):
+    import app
+    app.after_fork()
@@ -2,4 +2,11 @@ from .saliency import *
 from .rollout import *
 from .make_movie import *
 from .policy import *
-from .overfit_atari import *
\ No newline at end of file
+from .overfit_atari import *
+from .store import *
+from .regions import *
+from .cache import *
+from .overlays import *
+from .access import *
+from .lod import *
+from .metrics import *
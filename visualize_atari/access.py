@@ -0,0 +1,188 @@
+# Read-only access to rollout stores for the dashboard: lazy, sliceable views that only read the frames asked for,
+# backed by a bounded cache of blocks of rows so that stores much larger than memory can be served.
+# MmapStore serves the same interface from a store exported to .npy files (store.py export)
+
+from __future__ import print_function
+import os, json
+import h5py
+import numpy as np
+
+from .cache import LRUCache
+from .store import decoded
+from .metrics import note_read
+
+block_bytes = 1 << 20 # rows are read (and cached) in blocks of about this many bytes
+
+def _rows_of(first, n):
+    # leading-axis index -> (rows to read as a range or array, whether the axis is dropped)
+    if isinstance(first, (int, np.integer)):
+        i = int(first) + n if first < 0 else int(first)
+        if not 0 <= i < n: raise IndexError('index {} is out of range for axis 0 with size {}'.format(first, n))
+        return range(i, i+1), True
+    if isinstance(first, slice):
+        return range(*first.indices(n)), False
+    return np.arange(n)[np.asarray(first)], False # integer or boolean arrays
+
+class LazyDataset():
+    # a dataset of the store that reads rows on indexing, through the store's block cache. indexing follows numpy;
+    # results are read-only views of cached blocks where possible, so copy before modifying them in place
+    def __init__(self, store, ds):
+        self.store, self.ds = store, ds
+        self.name, self.shape, self.dtype, self.attrs = ds.name, ds.shape, ds.dtype, ds.attrs
+        row_bytes = ds.dtype.itemsize * int(np.prod(ds.shape[1:]))
+        self.block = max(1, block_bytes // max(row_bytes, 1))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[()], dtype)
+
+    def _block(self, b):
+        def read():
+            data = self.ds[b*self.block:(b+1)*self.block]
+            data.flags.writeable = False
+            note_read(data.nbytes) # only actual reads count, not block cache hits
+            return data
+        return self.store.cache.get_or_build((self.name, b), read)
+
+    def _read(self, lo, hi):
+        # rows lo:hi, from as few cached blocks as possible
+        b0, b1 = lo // self.block, (hi-1) // self.block
+        data = self._block(b0) if b0 == b1 else np.concatenate([self._block(b) for b in range(b0, b1+1)])
+        return data[lo - b0*self.block : hi - b0*self.block]
+
+    def _read_within(self, rows, drop, rest):
+        # a selection inside the rows (a few corners of every summed-area table, say) is left to h5py, which only reads
+        # the chunks it touches, rather than read as whole rows. None if h5py can't do this selection
+        if drop: first = rows[0]
+        elif isinstance(rows, range) and rows.step > 0: first = slice(rows.start, rows.stop, rows.step)
+        elif isinstance(rows, range): return None
+        else: first = rows
+        try:
+            data = self.ds[(first,) + tuple(rest)]
+        except (TypeError, ValueError, IndexError): # e.g. unsorted or several index arrays
+            return None
+        note_read(np.asarray(data).nbytes)
+        return data
+
+    def __getitem__(self, idx):
+        if self.shape == (): return self.ds[idx]
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        first, rest = (idx[0], idx[1:]) if idx and idx[0] is not Ellipsis else (slice(None), idx)
+        rows, drop = _rows_of(first, self.shape[0])
+        if len(rows) and any(r is not Ellipsis and not (isinstance(r, slice) and r == slice(None)) for r in rest):
+            data = self._read_within(rows, drop, rest)
+            if data is not None: return data
+        if rest and not drop and rest[0] is not Ellipsis: rest = (slice(None),) + rest # rest indexes the axes after the rows
+        if len(rows) == 0:
+            data = np.empty((0,) + self.shape[1:], self.dtype)
+        else:
+            lo, hi = int(np.min(rows)), int(np.max(rows)) + 1
+            data = self._read(lo, hi)
+            if drop: data = data[0]
+            elif isinstance(rows, range) and rows.step == 1: pass
+            elif isinstance(rows, range): data = data[rows.start-lo :: rows.step][:len(rows)]
+            else: data = data[rows - lo]
+        return data[rest] if rest else data
+
+class LazyGroup():
+    # a group of the store. indexing returns LazyGroups and LazyDatasets, so existing h5py-style code works unchanged
+    def __init__(self, store, group):
+        self.store, self.group = store, group
+        self.name, self.attrs = group.name, group.attrs
+
+    def __getitem__(self, path):
+        return self.store.wrap(self.group[path])
+
+    def __contains__(self, path):
+        return path in self.group
+
+    def __iter__(self):
+        return iter(self.group)
+
+    def keys(self):
+        return self.group.keys()
+
+    def items(self):
+        return [(k, self[k]) for k in self.group.keys()]
+
+class RolloutStore(LazyGroup):
+    # opens an h5 rollout store read-only from disk. cache_bytes bounds the memory used for cached blocks
+    def __init__(self, path, cache_bytes=256 << 20):
+        self.path = path
+        self.cache = LRUCache(maxsize=1 << 20, max_bytes=cache_bytes, sizeof=lambda a: a.nbytes)
+        LazyGroup.__init__(self, self, h5py.File(path, 'r'))
+
+    def wrap(self, obj):
+        # quantized saliency and encoded frames (see store.py) are decoded on read
+        if isinstance(obj, h5py.Group): return LazyGroup(self, obj)
+        return decoded(LazyDataset(self, obj), obj.attrs, lambda suffix: self[obj.name + suffix])
+
+    def reopen(self):
+        # for forked server workers: HDF5 file handles must not be shared between processes. cached blocks stay valid
+        self.group = h5py.File(self.path, 'r')
+        self.name, self.attrs = self.group.name, self.group.attrs
+
+    def close(self):
+        self.cache.clear() ; self.group.close()
+
+#====================== Memory-mapped backend: zero-copy views shared by every process through the page cache =========#
+
+class MmapGroup():
+    # a group of an exported store. datasets are read-only np.memmap arrays, so slicing them reads nothing until used
+    def __init__(self, store, name):
+        self.store, self.name = store, name
+        self.attrs = store.attrs_of.get(name, {})
+        self.dir = os.path.join(store.root, name.lstrip('/'))
+
+    def _path(self, path):
+        return path if path.startswith('/') else self.name.rstrip('/') + '/' + path
+
+    def __getitem__(self, path):
+        return self.store.open(self._path(path))
+
+    def __contains__(self, path):
+        full = os.path.join(self.store.root, self._path(path).lstrip('/'))
+        return os.path.isdir(full) or os.path.exists(full + '.npy')
+
+    def keys(self):
+        names = [k[:-4] if k.endswith('.npy') else k for k in sorted(os.listdir(self.dir))
+                 if k.endswith('.npy') or os.path.isdir(os.path.join(self.dir, k))]
+        return names
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+class MmapStore(MmapGroup):
+    # opens a store exported with python store.py export src.h5 dir. nothing is copied into the process: several
+    # dashboard workers opening the same directory share its pages through the OS page cache
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'attrs.json')) as f:
+            self.attrs_of = json.load(f)
+        self.arrays = {}
+        self.store, self.name, self.attrs, self.dir = self, '/', self.attrs_of.get('/', {}), root
+
+    def open(self, name):
+        name = '/' + name.strip('/')
+        full = os.path.join(self.root, name.lstrip('/'))
+        if os.path.isdir(full):
+            return MmapGroup(self, name)
+        if name not in self.arrays:
+            self.arrays[name] = decoded(np.load(full + '.npy', mmap_mode='r'), self.attrs_of.get(name, {}),
+                                        lambda suffix: self.open(name + suffix))
+        return self.arrays[name]
+
+    def reopen(self):
+        pass # read-only memory maps can be shared with forked processes as they are
+
+    def close(self):
+        self.arrays.clear()
+
+def open_store(path, cache_bytes=256 << 20):
+    # MmapStore for a directory of exported .npy files, RolloutStore for an h5 file
+    return MmapStore(path) if os.path.isdir(path) else RolloutStore(path, cache_bytes)
@@ -0,0 +1,218 @@
+# Small caches shared by the dashboard's data access and figure code
+
+import os, json, pickle, hashlib, shutil, threading, functools
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+
+from .metrics import note_cache
+
+class LRUCache():
+    # least-recently-used cache bounded by number of entries and, optionally, by total size as measured by sizeof.
+    # thread-safe, since Dash callbacks can run on several threads. hits/misses count get() outcomes
+    def __init__(self, maxsize=1024, max_bytes=None, sizeof=len):
+        self.maxsize, self.max_bytes, self.sizeof = maxsize, max_bytes, sizeof
+        self.data, self.nbytes = OrderedDict(), 0
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                self.data.move_to_end(key) ; self.hits += 1
+                return self.data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self.lock:
+            if key in self.data:
+                self.nbytes -= self.sizeof(self.data.pop(key)) if self.max_bytes is not None else 0
+            if self.max_bytes is not None and size > self.max_bytes:
+                return value # would evict everything else and still not fit
+            self.data[key] = value ; self.nbytes += size
+            while len(self.data) > self.maxsize or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+                _, old = self.data.popitem(last=False)
+                self.nbytes -= self.sizeof(old) if self.max_bytes is not None else 0
+        return value
+
+    def get_or_build(self, key, build):
+        # value for key, calling build() to make (and cache) it on a miss
+        missing = object()
+        value = self.get(key, missing)
+        return self.put(key, build()) if value is missing else value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear() ; self.nbytes = 0
+
+    def stats(self):
+        return {'entries': len(self.data), 'bytes': self.nbytes, 'hits': self.hits, 'misses': self.misses}
+
+class FigureCache():
+    # memoizes figure-building callbacks on (callback name, input values). figures are kept in memory in an LRU
+    # bounded by max_bytes of their pickled size and, with disk_dir, pickled to a directory that every server process
+    # on the machine shares, bounded by disk_bytes (least recently used files go first). version names the data the
+    # figures were built from (e.g. the store's mtime): directories of other versions that a FigureCache created are
+    # deleted when the cache is opened
+    marker = '.figure_cache' # in every version directory, so only those are ever deleted
+
+    def __init__(self, max_bytes=128 << 20, disk_dir=None, version='', disk_bytes=1 << 30):
+        self.lru = LRUCache(maxsize=1 << 16, max_bytes=max_bytes, sizeof=lambda v: v[1])
+        self.version, self.disk_bytes, self.disk_used = str(version), disk_bytes, 0
+        self.disk_hits, self.disk_errors = 0, 0
+        self.lock = threading.Lock()
+        self.disk_dir = None if disk_dir is None else os.path.join(disk_dir, hashlib.sha1(self.version.encode()).hexdigest()[:16])
+        if self.disk_dir is not None:
+            self._open_dir()
+            for old in os.listdir(disk_dir):
+                old = os.path.join(disk_dir, old)
+                if old != self.disk_dir and os.path.exists(os.path.join(old, self.marker)): shutil.rmtree(old, ignore_errors=True)
+            self._evict()
+
+    def _open_dir(self):
+        # (re)creates the version directory: a server of a newer version may have deleted it under a running one
+        if not os.path.exists(os.path.join(self.disk_dir, self.marker)):
+            os.makedirs(self.disk_dir, exist_ok=True)
+            with open(os.path.join(self.disk_dir, self.marker), 'w') as f:
+                f.write(self.version)
+
+    def key(self, name, args):
+        return hashlib.sha1(json.dumps([name, args], sort_keys=True, default=str).encode()).hexdigest()
+
+    def _load(self, key):
+        path = os.path.join(self.disk_dir, key + '.pkl')
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path) # recently used: evicted last
+        except OSError:
+            return None
+        self.disk_hits += 1
+        return pickle.loads(data), len(data)
+
+    def _save(self, key, data):
+        # best effort: a full disk or a deleted directory costs the disk copy, not the callback
+        path = os.path.join(self.disk_dir, key + '.pkl')
+        tmp = path + '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+        try:
+            self._open_dir()
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path) # readers in other processes never see half a file
+        except OSError:
+            self.disk_errors += 1
+            if os.path.exists(tmp): os.remove(tmp)
+            return
+        self.disk_used += len(data)
+        if self.disk_used > self.disk_bytes: self._evict()
+
+    def _evict(self):
+        # deletes the least recently used files (written or hit longest ago, by any process) until the directory is
+        # well under disk_bytes, so that it is not scanned again on every save
+        with self.lock:
+            files = []
+            for f in os.listdir(self.disk_dir) if os.path.isdir(self.disk_dir) else []:
+                if not f.endswith('.pkl'): continue
+                try:
+                    st = os.stat(os.path.join(self.disk_dir, f))
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, os.path.join(self.disk_dir, f)))
+            used = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if used <= self.disk_bytes * 3 // 4: break
+                try:
+                    os.remove(path) ; used -= size
+                except OSError:
+                    pass
+            self.disk_used = used
+
+    def get_or_build(self, name, args, build):
+        key, missing = self.key(name, args), object()
+        entry = self.lru.get(key, missing)
+        if entry is missing:
+            entry = self._load(key) if self.disk_dir is not None else None
+            note_cache(entry is not None)
+            if entry is None:
+                figure = build() ; data = pickle.dumps(figure)
+                if self.disk_dir is not None: self._save(key, data)
+                entry = figure, len(data)
+            self.lru.put(key, entry)
+        else: note_cache(True)
+        return entry[0] # shared between requests, so never modified
+
+    def memoize(self, func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            return self.get_or_build(func.__name__, args, lambda: func(*args))
+        return wrapper
+
+    def clear(self):
+        self.lru.clear()
+        if self.disk_dir is not None:
+            for f in os.listdir(self.disk_dir):
+                if f.endswith('.pkl'): os.remove(os.path.join(self.disk_dir, f))
+            self.disk_used = 0
+
+    def stats(self):
+        stats = self.lru.stats()
+        stats.update(disk_hits=self.disk_hits, disk_bytes=self.disk_used, disk_errors=self.disk_errors)
+        return stats
+
+class StaticFigures():
+    # figures that depend on nothing but some files (the store, a training log): built once, by a pool of threads, and
+    # rebuilt when one of the watched files (default: all of them) changes. files that are not watched are only read at
+    # startup, e.g. a store whose layout the rest of the app also loads once. with path the figures are also pickled
+    # there along with the files' mtimes, so server restarts and the other server processes load them instead of
+    # building them again, as long as none of the files changed
+    def __init__(self, builders, files, path=None, threads=4, watch=None):
+        self.builders, self.files, self.path, self.threads = builders, files, path, threads
+        self.watch = files if watch is None else watch
+        self.figures, self.stamp = {}, None
+        self.lock = threading.Lock()
+
+    def _stamp(self, files):
+        return [[f, os.path.getmtime(f) if os.path.exists(f) else None] for f in files]
+
+    def _changed(self):
+        return self._stamp(self.watch) != [s for s in self.stamp if s[0] in self.watch]
+
+    def _load(self, stamp):
+        try:
+            with open(self.path, 'rb') as f:
+                saved = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        ok = saved['stamp'] == stamp and set(saved['figures']) == set(self.builders)
+        return saved['figures'] if ok else None
+
+    def build(self):
+        stamp = self._stamp(self.files)
+        if self.stamp is not None: # rebuilding: unwatched files are still as the builders saw them at startup
+            stamp = [new if new[0] in self.watch else old for new, old in zip(stamp, self.stamp)]
+        figures = self._load(stamp) if self.path else None
+        if figures is None:
+            with ThreadPoolExecutor(self.threads) as pool:
+                futures = {name: pool.submit(build) for name, build in self.builders.items()}
+                figures = {name: future.result() for name, future in futures.items()}
+            if self.path:
+                with open(self.path + '.{}.tmp'.format(os.getpid()), 'wb') as f:
+                    pickle.dump({'stamp': stamp, 'figures': figures}, f)
+                os.replace(self.path + '.{}.tmp'.format(os.getpid()), self.path)
+        self.figures, self.stamp = figures, stamp
+        return self
+
+    def get(self, name):
+        rebuilt = False
+        if self._changed():
+            with self.lock:
+                if self._changed(): self.build() ; rebuilt = True
+        note_cache(not rebuilt)
+        return self.figures[name]
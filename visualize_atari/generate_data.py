@@ -4,14 +4,14 @@
 from __future__ import print_function
 
 import pandas as pd
-import h5py 
+import h5py
 
 import torch
 from torch.autograd import Variable
 
 import torch.nn.functional as F
 
-import gym, os, sys, time, argparse
+import gym, os, sys, time, json, hashlib, argparse
 sys.path.append('..')
 from visualize_atari import *
 
@@ -20,60 +20,85 @@ env_name = 'Breakout-v0'
 save_dir = 'figures/'
 model_folder = 'models_model7-02-17-20-41'
 load_dir = '../baby-a3c/breakout-v4/'+model_folder + '/'
-def get_rollout(model, seed = 1):
+store_path = '../static/model_rollouts_5_temp.h5'
+shard_dir = '../static/saliency_shards/' # per-worker result shards, merged into the store when all are done
+def get_rollout(model, seed = 1, writer = None):
     meta = get_env_meta(env_name)
     env = gym.make(env_name) ; env.seed(seed)
     env.reset()
-    history = rollout(model, env, max_ep_len=3e3)
+    history = rollout(model, env, max_ep_len=max_ep_len, writer=writer)
     env.close()
     return history
 
-
-# Some datafile to store data
-if 'model_rollouts_5_temp.h5' not in os.listdir('../static'):
-    store = h5py.File('../static/model_rollouts_5_temp.h5','w')
-else:
-    store = h5py.File('../static/model_rollouts_5_temp.h5','a')
-
+def get_rollouts(model, seeds, writers = None):
+    # one seeded env per episode, all stepped in lockstep with batched policy inference
+    envs = [gym.make(env_name) for seed in seeds]
+    for env, seed in zip(envs, seeds):
+        env.seed(seed) ; env.reset()
+    histories = rollout_vec(model, envs, max_ep_len=max_ep_len, writers=writers)
+    for env in envs: env.close()
+    return histories
 
 
 exceptions = []
 episodes = 5 # episodes to replay per iteration
+max_ep_len = 3000 # rollouts are streamed to the store, so this only bounds run time, not memory
 iterations = [1,19,30,40,50,60,70,80,90,100] # iterations we want to look at
+saliency_method = 'perturbation' # any key of saliency_backends: perturbation, adaptive, incremental, jacobian, grad_x_input, integrated
+radius = 5
+density = 5
+batch_size = 256 # perturbed inputs per forward pass (a full d=5 grid in one batch)
+chunk_size = 32 # saliency frames per work item
+processes = torch.multiprocessing.cpu_count() # set to 1 to score everything in this process
+threads_per_process = 1 # intra-op threads of each worker; processes*threads_per_process should not exceed the core count
+overwrite = False # recompute saliency that is already in the store
+compression = 'lzf' # filter for new datasets, see visualize_atari/store.py
+frame_codec = 'raw' # 'palette' stores ins palette-indexed and XORed against keyframes (see visualize_atari/store.py)
+quantization = 'none' # store saliency maps as uint8 or float16 with a per-frame scale and offset (see visualize_atari/store.py)
+# also store summed-area tables of the saliency maps for arbitrary region queries (see visualize_atari/regions.py). off by
+# default: in float64 they take about twice the space of float32 saliency, and the dashboard only needs the aggregates
+sat = False
+args = None # parsed command line, see the bottom of this file
+
+
+rollout_keys = ['ins', 'logits', 'values', 'outs', 'hx', 'reward']
+sal_keys = ['actor_sal', 'critic_sal']
 
 
 def filter_iterations(x):
     return any('.'+str(i)+'.' in x for i in iterations)
 
-if len(sys.argv)==1 or sys.argv[1]==1:
+def history_path(iteration, ep):
+    return os.path.join(model_folder, 'model.'+str(iteration)+'.tar', 'history', str(ep))
+
+def rollout_done(store, path):
+    # streamed rollouts are flagged 'partial' until their last step is written
+    return all(path + '/' + k in store for k in rollout_keys) and not store[path].attrs.get('partial', False)
+
+def rollout_stage(store):
     for modelname in filter(filter_iterations, os.listdir(load_dir)):
         iteration = modelname.split('.')[-2]
+        todo = [ep for ep in range(episodes) if not rollout_done(store, history_path(iteration, ep))]
+        if len(todo) == 0:
+            print(f'{modelname}: all {episodes} rollouts already in store, skipping')
+            continue
         print(modelname)
         print("initialize agent and try to load saved weights...")
         model = NNPolicy(channels=1, num_actions=4, memsize=256)
         _ = model.try_load(load_dir, checkpoint='*'+str(iteration)+'.tar')
         torch.manual_seed(1)
-        for ep in range(episodes):
-            print(f'getting rollout of {modelname} on ep {ep}')
-            history = get_rollout(model, ep + 1)
-            path = model_folder
-            for k in history.keys():
-                target = np.stack(history[k], axis=0)
-                if k == "ins":
-                    store.create_dataset(os.path.join(path, modelname, 
-                                    'history',str(ep), k), data = target[::5])
-                                    #compression = "gzip")
-                else:
-                    store.create_dataset(os.path.join(path, modelname, 
-                    'history',str(ep), k), data = target)
-                print('saved rollout at', os.path.join(path, modelname, 
-                                    'history',str(ep), k))
-
-# do only saliency
-if len(sys.argv) > 1 and sys.argv[1]==1:
-    store.close()
-    exit()
-    
+        writers = []
+        for ep in todo:
+            path = history_path(iteration, ep)
+            for k in rollout_keys + ['ins_palette']: # drop whatever an interrupted run left of this episode
+                if path + '/' + k in store: del store[path + '/' + k]
+            encoders = {'ins': FrameEncoder()} if frame_codec == 'palette' else {}
+            writers.append(RolloutWriter(store.require_group(path), strides={'ins': 5}, compression=compression, # 5 frame increments of ins
+                                         encoders=encoders))
+        print(f'getting rollouts of {modelname} on eps {todo}')
+        get_rollouts(model, [ep + 1 for ep in todo], writers=writers)
+        print('saved rollouts at', history_path(iteration, '*'))
+        store.flush()
 
 
 def saliency_on_atari_frame_short(saliency, atari, fudge_factor, channel=2, sigma=0):
@@ -86,88 +111,188 @@ def saliency_on_atari_frame_short(saliency, atari, fudge_factor, channel=2, sigm
     return S
 
 
-from torch.multiprocessing import Pool
-CPU_COUNT = torch.multiprocessing.cpu_count()
+#====================== Parallel saliency: one work item per (snapshot, episode, frame chunk) =================#
+# models are loaded once in the parent and handed to the workers through shared memory (read-only), every
+# worker reads its frames straight from the (closed, read-only) store and writes its maps to a .npz shard
 
-# uncomment commented-out lines later to use multi-processing (but in my experience this performed worse than single-processing)
+models = {} # iteration -> NNPolicy, set in every worker by init_worker
 
-def get_saliency_mp(model, ins_instance, hx_instance):
-    radius = 5
-    density = 5
-    print(ins_instance.shape, hx_instance.shape)
-    actor_saliency = score_frame(model, ins_instance, hx_instance, radius, density, interp_func=occlude, mode='actor')
-    critic_saliency = score_frame(model, ins_instance, hx_instance, radius, density, interp_func=occlude, mode='critic')
-    frame = ins_instance.squeeze().copy()
+def load_models(iterations):
+    loaded = {}
+    for iteration in iterations:
+        try:
+            model = NNPolicy(channels=1, num_actions=4, memsize=256)
+            _ = model.try_load(load_dir, checkpoint='*.'+str(iteration)+'.tar')
+        except:
+            print("exception at iteration: ",iteration)
+            continue
+        model.eval() ; model.share_memory()
+        loaded[iteration] = model
+    return loaded
 
-    actor_map = saliency_on_atari_frame_short(actor_saliency, frame, fudge_factor=100, channel=2)
-    critic_map = saliency_on_atari_frame_short(critic_saliency, frame, fudge_factor=1000, channel=0)
+def init_worker(shared_models, threads, args=None):
+    global models
+    models = shared_models
+    if args is not None: configure(args) # spawned workers do not inherit the parent's settings
+    torch.set_num_threads(threads)
 
-    return (actor_map, critic_map)
+def shard_run_dir():
+    # shards of this store and these scoring settings: <shard_dir>/<store name>/<hash of store, models and settings>,
+    # so shards left over from another store or other settings are never taken for finished chunks of this one
+    settings = [os.path.abspath(store_path), os.path.abspath(load_dir), saliency_method, radius, density, chunk_size]
+    key = hashlib.sha1(json.dumps(settings).encode()).hexdigest()[:16]
+    return os.path.join(shard_dir, os.path.splitext(os.path.basename(store_path))[0], key)
 
-pool = Pool(processes = CPU_COUNT)
-for iteration in [1,19,30,40,50,60,70,80,90,100]:
-    print("running iteration ",iteration)
-    try:
-        model = NNPolicy(channels=1, num_actions=4, memsize=256)
-        _ = model.try_load(load_dir, checkpoint='*.'+str(iteration)+'.tar')
-        
-    except:
-        print("exception at iteration: ",iteration)
-        continue
-    
-    for ep in range(episodes):
-        print(f'getting saliency maps of {iteration} on ep {ep}')
-        ins = store[model_folder + '/model.'+str(iteration)+'.tar/history/'+str(ep)+'/ins'].value # 5 frame increments
-        hx = store[model_folder + '/model.'+str(iteration)+'.tar/history/'+str(ep)+'/hx'].value # 5 frame increments
-        history = {'ins':ins, 'hx':hx}
-
-        meta = get_env_meta(env_name)
-        env = gym.make(env_name) ; env.seed(ep+1)
-        env.reset()
-        
-        radius = 5
-        density = 5
-        actor_frames = []
-        critic_frames = []
-        frame_data = ins.copy()
-        
-        # 1 frame increments stored in rollout data, we use 5 frame increments to generate saliency maps
-        for frame_ix in range(0, ins.shape[0]):
-            print(f'sal frame {frame_ix} of model {iteration}')
-            actor_saliency = score_frame(model, history, frame_ix, radius, density, interp_func=occlude, mode='actor')
-            critic_saliency = score_frame(model, history, frame_ix, radius, density, interp_func=occlude, mode='critic')
-            frame = history['ins'][frame_ix].squeeze().copy()
-            
-            actor_map = saliency_on_atari_frame_short(actor_saliency, frame, fudge_factor=100, channel=2)
-            critic_map = saliency_on_atari_frame_short(critic_saliency, frame, fudge_factor=1000, channel=0)
-            
-            actor_frames.append(actor_map)
-            critic_frames.append(critic_map)
-            
-        actor_frames = np.array(actor_frames)
-        critic_frames = np.array(critic_frames)
-        
-#         model_rep = [model for i in range(len(frame_data))]
-#         mp_in = zip(model_rep, frame_data, np.roll(hx, 1, 0))
-#         actor_frames, critic_frames = zip(*pool.starmap(get_saliency_mp, mp_in))
-
-        path = model_folder
-        modelname = 'model.'+str(iteration)+'.tar'
-        actor_path = os.path.join(path, modelname, 'history',str(ep), 'actor_sal')
-        critic_path = os.path.join(path, modelname, 'history',str(ep), 'critic_sal')
-        if actor_path in store:
-            a = store[actor_path]
-            a[:,:,:] = actor_frames
-            c = store[critic_path]
-            c[:,:,:] = critic_frames
-        else:
-            store.create_dataset(actor_path, data = actor_frames) 
-            store.create_dataset(critic_path, data = critic_frames)
-        print('saved saliency at', os.path.join(path, modelname, 
-                                'history',str(ep), '<SAL_TYPE>'))
-
-# Pool.close()
-# Pool.join()
-
-store.close()
-        
+def shard_path(iteration, ep, start, stop):
+    return os.path.join(shard_run_dir(), '{}-{}-{}-{}-{}.npz'.format(saliency_method, iteration, ep, start, stop))
+
+def saliency_chunk(iteration, ep, start, stop):
+    path = history_path(iteration, ep)
+    with h5py.File(store_path, 'r') as store:
+        ins = open_dataset(store, path + '/ins')[start:stop] # 5 frame increments
+        hx = store[path + '/hx'][()]
+    # score_frame looks up hx[ix*5-1]; rolling hx lets it use chunk-local frame indices
+    history = {'ins': ins, 'hx': np.roll(hx, -start*5, axis=0)}
+    if saliency_method in ['perturbation', 'adaptive', 'incremental']:
+        sal_kwargs = dict(r=radius, d=density, interp_func=occlude, batch_size=batch_size)
+    else:
+        sal_kwargs = dict(batch_size=64)
+    actor_sals, critic_sals = score_frames(models[iteration], history, range(0, ins.shape[0]), method=saliency_method, **sal_kwargs)
+
+    actor_frames, critic_frames = [], []
+    for frame_ix in range(0, ins.shape[0]):
+        frame = history['ins'][frame_ix].squeeze().copy()
+        actor_frames.append(saliency_on_atari_frame_short(actor_sals[frame_ix], frame, fudge_factor=100, channel=2))
+        critic_frames.append(saliency_on_atari_frame_short(critic_sals[frame_ix], frame, fudge_factor=1000, channel=0))
+
+    shard = shard_path(iteration, ep, start, stop)
+    np.savez(shard + '.tmp.npz', actor_sal=np.array(actor_frames), critic_sal=np.array(critic_frames))
+    os.rename(shard + '.tmp.npz', shard) # a shard only appears once it is complete
+    return iteration, ep, start, shard
+
+def saliency_tasks(store):
+    # work items of every (snapshot, episode) that has a rollout but no saliency yet (or all of them with
+    # overwrite). chunks whose shard survived an earlier, interrupted run are returned separately as finished
+    tasks, finished = [], []
+    for iteration in iterations:
+        for ep in range(episodes):
+            path = history_path(iteration, ep)
+            if not rollout_done(store, path):
+                print(f'no rollout of model {iteration} ep {ep} in store, skipping its saliency')
+                continue
+            if not overwrite and all(path + '/' + k in store for k in sal_keys):
+                continue
+            n = store[path + '/ins'].shape[0]
+            for start in range(0, n, chunk_size):
+                task = (iteration, ep, start, min(start + chunk_size, n))
+                if os.path.exists(shard_path(*task)):
+                    finished.append(task[:3] + (shard_path(*task),))
+                else:
+                    tasks.append(task)
+    return tasks, finished
+
+def merge_shards(store, iteration, ep, shards):
+    parts = [np.load(s) for s in shards] # shards in frame order
+    sal = {k: np.concatenate([p[k] for p in parts]) for k in sal_keys}
+    history = store[history_path(iteration, ep)]
+    reports = [write_saliency(history, k, sal[k], compression, quantization) for k in sal_keys] # replaces old ones with overwrite
+    write_aggregates(history, compute_aggregates(sal), compression=compression) # from the unquantized maps
+    if sat: write_index(history, compression=compression)
+    write_lod(history, compression=compression)
+    for s in shards: os.remove(s)
+    print('saved saliency at', history_path(iteration, ep) + '/<SAL_TYPE>')
+    if quantization != 'none':
+        print('  quantized to {}: {}'.format(quantization, format_report(merge_reports(reports))))
+
+def saliency_stage():
+    os.makedirs(shard_run_dir(), exist_ok=True)
+    with h5py.File(store_path, 'r') as store:
+        tasks, results = saliency_tasks(store)
+    if len(results):
+        print(f'reusing {len(results)} chunks of saliency from an earlier run')
+    loaded = load_models(sorted(set(task[0] for task in tasks)))
+    print(f'scoring {len(tasks)} chunks of saliency with {processes} processes')
+    start_time = time.time()
+    if processes > 1:
+        pool = torch.multiprocessing.Pool(processes, initializer=init_worker, initargs=(loaded, threads_per_process, args))
+        results += pool.starmap(saliency_chunk, tasks, chunksize=1)
+        pool.close() ; pool.join()
+    else:
+        init_worker(loaded, torch.get_num_threads())
+        results += [saliency_chunk(*task) for task in tasks]
+    print('scored saliency in {:.0f}s'.format(time.time() - start_time))
+
+    # workers only read the store, so results are merged once they are all done and nobody has it open
+    shards = {}
+    for iteration, ep, start, shard in sorted(results):
+        shards.setdefault((iteration, ep), []).append(shard)
+    with h5py.File(store_path, 'a') as store:
+        for (iteration, ep), ep_shards in shards.items():
+            merge_shards(store, iteration, ep, ep_shards)
+
+
+def aggregate_stage(store):
+    # per-frame saliency totals, quadrant sums, summed-area tables and level-of-detail timelines for the dashboard,
+    # for episodes whose saliency predates them
+    for iteration in iterations:
+        for ep in range(episodes):
+            path = history_path(iteration, ep)
+            if path not in store or not all(k in store[path] for k in sal_keys):
+                continue
+            if overwrite or 'aggregates' not in store[path]:
+                write_aggregates(store[path], compression=compression)
+                print('saved saliency aggregates at', path + '/aggregates')
+            if sat and (overwrite or 'sat' not in store[path]):
+                write_index(store[path], compression=compression)
+                print('saved saliency summed-area tables at', path + '/sat')
+            if overwrite or 'lod' not in store[path] or 'critic_regions' not in store[path + '/lod']:
+                write_lod(store[path], compression=compression)
+                print('saved level-of-detail timelines at', path + '/lod')
+
+
+def configure(parsed):
+    global args
+    args = parsed
+    globals().update({k: v for k, v in vars(parsed).items() if k != 'stage'})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='roll out model snapshots and score their saliency into an h5 store.'
+                                     ' entries already in the store are skipped, so an interrupted run can just be restarted')
+    parser.add_argument('stage', nargs='?', default='all', choices=['all', 'rollout', 'saliency', 'aggregates'], help='which stage(s) to run')
+    parser.add_argument('-e', '--env_name', default=env_name, type=str, help='gym environment')
+    parser.add_argument('-m', '--model_folder', default=model_folder, type=str, help='folder of model snapshots, also the group name in the store')
+    parser.add_argument('-l', '--load_dir', default=None, type=str, help='dir with the model snapshots (default ../baby-a3c/breakout-v4/<model_folder>/)')
+    parser.add_argument('-i', '--iterations', default=iterations, type=int, nargs='+', help='snapshot iterations to process')
+    parser.add_argument('-n', '--episodes', default=episodes, type=int, help='episodes to replay per snapshot')
+    parser.add_argument('--max_ep_len', default=max_ep_len, type=int, help='max steps per rollout')
+    parser.add_argument('-s', '--store_path', default=store_path, type=str, help='h5 file to write to')
+    parser.add_argument('--compression', default=compression, type=str, choices=sorted(compressors), help='compression of new datasets')
+    parser.add_argument('--frame_codec', default=frame_codec, choices=['raw', 'palette'],
+                        help='store frames raw or palette-indexed and XORed against keyframes')
+    parser.add_argument('--quantize', dest='quantization', default=quantization, choices=['none'] + sorted(quant_levels),
+                        help='store saliency maps quantized to this type')
+    parser.add_argument('--sat', dest='sat', default=sat, action='store_true', help='also store saliency summed-area tables (about 2x the size of float32 saliency)')
+    parser.add_argument('--shard_dir', default=shard_dir, type=str, help='dir for per-chunk saliency results')
+    parser.add_argument('--saliency_method', default=saliency_method, type=str, choices=sorted(saliency_backends), help='saliency backend')
+    parser.add_argument('-r', '--radius', default=radius, type=int, help='radius of gaussian blur')
+    parser.add_argument('-d', '--density', default=density, type=int, help='density of grid of gaussian blurs')
+    parser.add_argument('-b', '--batch_size', default=batch_size, type=int, help='perturbed inputs per forward pass')
+    parser.add_argument('-c', '--chunk_size', default=chunk_size, type=int, help='saliency frames per work item')
+    parser.add_argument('-p', '--processes', default=processes, type=int, help='saliency worker processes')
+    parser.add_argument('-t', '--threads_per_process', default=threads_per_process, type=int, help='intra-op threads per worker')
+    parser.add_argument('-o', '--overwrite', default=False, action='store_true', help='recompute saliency (and its aggregates) that is already in the store')
+    parsed = parser.parse_args()
+    parsed.load_dir = parsed.load_dir or '../baby-a3c/breakout-v4/' + parsed.model_folder + '/'
+    configure(parsed)
+
+    if args.stage in ['all', 'rollout']:
+        with h5py.File(store_path, 'a') as store:
+            rollout_stage(store)
+    if args.stage in ['all', 'saliency']:
+        saliency_stage()
+    if args.stage in ['all', 'aggregates']:
+        with h5py.File(store_path, 'a') as store:
+            aggregate_stage(store)
+    write_manifest(store_path) # the dashboard reads the store's layout from it
+    print('saved manifest at', manifest_path(store_path))
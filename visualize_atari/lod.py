@@ -0,0 +1,110 @@
+# Level-of-detail pyramids of per-frame series (rewards, action probabilities, saliency by quadrant), so zoomable charts
+# can send about the same number of points whatever the episode length and zoom level
+
+from __future__ import print_function
+import numpy as np
+
+from .store import create_dataset
+from .regions import load_aggregates
+
+lod_factor = 4 # each level has buckets lod_factor times longer than the one below it
+lod_min_buckets = 64 # stop adding levels once a level has at most this many buckets
+lod_stats = ['min', 'max', 'mean'] # axis 1 of every level
+lod_series = ['reward', 'cum_reward', 'outs', 'actor_regions', 'critic_regions']
+sal_stride = 5 # saliency (and so its quadrant sums) is scored on every 5th frame
+
+def pyramid(x, factor=lod_factor, min_buckets=lod_min_buckets):
+    # (T,...) series -> [(bucket, (n,3,...) min/max/mean of every bucket of samples)], finest (bucket 1) first
+    x = np.asarray(x, dtype=np.float32)
+    levels, bucket = [], 1
+    while True:
+        starts = np.arange(0, len(x), bucket)
+        if len(starts) == 0:
+            return [(1, np.zeros((0, 3) + x.shape[1:], np.float32))]
+        counts = np.diff(np.append(starts, len(x))).reshape((-1,) + (1,) * (x.ndim - 1))
+        stats = [np.minimum.reduceat(x, starts), np.maximum.reduceat(x, starts), np.add.reduceat(x, starts, dtype=np.float64) / counts]
+        levels.append((bucket, np.stack(stats, axis=1).astype(np.float32)))
+        if len(starts) <= min_buckets: return levels
+        bucket *= factor
+
+class Timeline():
+    # the pyramid of one series. levels are (bucket, data) pairs, data an array or a (lazy) dataset; stride is the
+    # number of episode frames per sample
+    def __init__(self, levels, stride=1):
+        self.levels, self.stride = levels, stride
+        self.length = len(levels[0][1]) * stride # episode frames covered
+
+    def level(self, lo, hi, max_points):
+        # index of the finest level with at most max_points buckets between episode frames lo and hi
+        samples = max(hi - lo, 1) / self.stride
+        for i, (bucket, _) in enumerate(self.levels):
+            if samples / bucket <= max_points: return i
+        return len(self.levels) - 1
+
+    def view(self, lo=None, hi=None, max_points=1000):
+        # (x, min, max, mean) of the buckets covering episode frames lo:hi, x being the frame each bucket starts at
+        lo = 0 if lo is None else min(max(int(lo), 0), self.length) # chart ranges can reach past the episode
+        hi = self.length if hi is None else min(max(int(hi), lo), self.length)
+        bucket, data = self.levels[self.level(lo, hi, max_points)]
+        b0, b1 = lo // (bucket * self.stride), -(-hi // (bucket * self.stride))
+        d = np.asarray(data[b0:b1])
+        return np.arange(b0, b1) * bucket * self.stride, d[:, 0], d[:, 1], d[:, 2]
+
+    def line(self, lo=None, hi=None, points=1000, stat='max', detail=4):
+        # (x, y) of at most points points tracing one stat of the series between episode frames lo and hi: read from
+        # the level with detail times more buckets, then thinned to points with lttb, so peaks and steps survive
+        x, mn, mx, mean = self.view(lo, hi, points * detail)
+        y = {'min': mn, 'max': mx, 'mean': mean}[stat]
+        keep = lttb(x, y, points)
+        return x[keep], y[keep]
+
+def lttb(x, y, n):
+    # indices of n points of the line (x, y) picked by largest-triangle-three-buckets (Steinarsson 2013): the first and
+    # last points are kept, and every bucket in between keeps the point making the largest triangle with the point kept
+    # from the previous bucket and the mean of the next bucket
+    size = len(x)
+    if n >= size or n < 3: return np.arange(size)
+    x, y = np.asarray(x, np.float64), np.asarray(y, np.float64)
+    edges = np.linspace(1, size - 1, n - 1).astype(int) # n-2 buckets over the points between the first and the last
+    keep = np.zeros(n, int) ; keep[-1] = size - 1
+    for i in range(n - 2):
+        lo, hi, next_hi = edges[i], edges[i+1], edges[i+2] if i + 2 < n - 1 else size
+        cx, cy = x[hi:next_hi].mean(), y[hi:next_hi].mean()
+        a = keep[i]
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        keep[i+1] = lo + int(np.argmax(area))
+    return keep
+
+def compact(y, digits=4):
+    # values rounded for figures: float32 samples would otherwise be sent to the browser with 17 significant digits
+    return np.round(np.asarray(y, np.float64), digits)
+
+def timeline_source(history, name):
+    # (samples, stride) of one of lod_series, or None if the episode does not have it (no saliency yet)
+    if name == 'cum_reward': return np.cumsum(history['reward'][()]), 1
+    if name in ['actor_regions', 'critic_regions']:
+        if not all(k in history for k in ['actor_sal', 'critic_sal']): return None
+        return load_aggregates(history)[name], sal_stride
+    return history[name][()], 1
+
+def write_lod(history, compression='lzf'):
+    # (re)writes history/lod/<series>/<bucket> for every series the episode has. levels are tiny next to the series
+    if 'lod' in history: del history['lod']
+    group = history.create_group('lod')
+    group.attrs['stats'] = lod_stats
+    for name in lod_series:
+        source = timeline_source(history, name)
+        if source is None: continue
+        series = group.create_group(name) ; series.attrs['stride'] = source[1]
+        for bucket, data in pyramid(source[0]):
+            create_dataset(series, str(bucket), data, compression)
+    return group
+
+def load_timeline(history, name):
+    # Timeline of one of lod_series, built in memory for stores that predate history/lod
+    if 'lod' in history and name in history['lod']:
+        series = history['lod'][name]
+        levels = sorted((int(bucket), series[bucket]) for bucket in series.keys())
+        return Timeline(levels, int(series.attrs['stride']))
+    samples, stride = timeline_source(history, name)
+    return Timeline(pyramid(samples), stride)
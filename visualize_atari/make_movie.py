@@ -45,8 +45,7 @@ def make_movie(env_name, checkpoint='*.tar', num_frames=20, first_frame=0, resol
             ix = first_frame+i
             if ix < total_frames: # prevent loop from trying to process a frame ix greater than rollout length
                 frame = history['ins'][ix].squeeze().copy()
-                actor_saliency = score_frame(model, history, ix, radius, density, interp_func=occlude, mode='actor')
-                critic_saliency = score_frame(model, history, ix, radius, density, interp_func=occlude, mode='critic')
+                actor_saliency, critic_saliency = score_frame(model, history, ix, radius, density, interp_func=occlude, mode='both')
             
                 frame = saliency_on_atari_frame(actor_saliency, frame, fudge_factor=meta['actor_ff'], channel=2)
                 frame = saliency_on_atari_frame(critic_saliency, frame, fudge_factor=meta['critic_ff'], channel=0)
@@ -0,0 +1,186 @@
+# Per-callback instrumentation for the dashboard: wall time, bytes read from the store, response payload size and
+# figure/overlay cache hits and misses of every Dash callback, as histograms on a /metrics route (Prometheus text
+# format), plus an optional log of slow callbacks. with shared_dir, every server process keeps its totals in a file
+# there (rewritten by a background thread at most every flush_ms) and /metrics serves the sum over all of them,
+# whichever process answers
+
+from __future__ import print_function
+import os, json, time, logging, threading, functools
+
+_local = threading.local() # the callback running on this thread, if any
+
+def note_read(nbytes):
+    # called by the data access layer for every read from the store
+    ctx = getattr(_local, 'ctx', None)
+    if ctx is not None: ctx['bytes_read'] += nbytes
+
+def note_cache(hit):
+    # called by the figure and overlay caches on every lookup
+    ctx = getattr(_local, 'ctx', None)
+    if ctx is not None: ctx['hits' if hit else 'misses'] += 1
+
+time_buckets = [.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30]
+byte_buckets = [1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18, 1 << 20, 1 << 22, 1 << 24, 1 << 26, 1 << 28]
+
+class Histogram():
+    # cumulative-bucket histogram, as Prometheus expects them
+    def __init__(self, buckets):
+        self.buckets, self.counts, self.sum, self.count = buckets, [0] * len(buckets), 0., 0
+
+    def observe(self, value):
+        for i, b in enumerate(self.buckets):
+            if value <= b: self.counts[i] += 1
+        self.sum += value ; self.count += 1
+
+    def state(self):
+        return {'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+def merge_states(a, b):
+    # sum of two states of the same metric: a histogram state or a counter
+    if not isinstance(a, dict): return a + b
+    return {'counts': [x + y for x, y in zip(a['counts'], b['counts'])], 'sum': a['sum'] + b['sum'], 'count': a['count'] + b['count']}
+
+def histogram_lines(name, labels, buckets, state):
+    out = ['{}_bucket{{{},le="{}"}} {}'.format(name, labels, b, c) for b, c in zip(buckets, state['counts'])]
+    out.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, labels, state['count']))
+    out.append('{}_sum{{{}}} {}'.format(name, labels, state['sum']))
+    out.append('{}_count{{{}}} {}'.format(name, labels, state['count']))
+    return out
+
+class CallbackMetrics():
+    # install(app) before the callbacks are registered: every @app.callback function is then wrapped to be measured.
+    # callbacks slower than slow_ms (if given) are logged to the 'dashboard.slow' logger, and to slow_log if given.
+    # shared_dir is emptied when the CallbackMetrics is made, so make it once, before the server forks its workers
+    # (gunicorn's preload_app). files of workers that exited stay, so that the counters never go down
+    def __init__(self, slow_ms=None, slow_log=None, shared_dir=None, flush_ms=1000):
+        self.slow_ms, self.shared_dir, self.flush_ms = slow_ms, shared_dir, flush_ms
+        self.series = {} # callback name -> dict of histograms and counters
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock() # file writes, kept out of self.lock so requests never wait on the disk
+        self.dirty, self.flusher_pid = False, None
+        if shared_dir is not None:
+            os.makedirs(shared_dir, exist_ok=True)
+            for f in os.listdir(shared_dir):
+                if f.endswith('.json'): os.remove(os.path.join(shared_dir, f)) # totals of an earlier server
+        self.log = logging.getLogger('dashboard.slow')
+        if slow_log:
+            handler = logging.FileHandler(slow_log)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.log.addHandler(handler) ; self.log.setLevel(logging.INFO)
+
+    def _series(self, name):
+        if name not in self.series:
+            self.series[name] = {'seconds': Histogram(time_buckets), 'read_bytes': Histogram(byte_buckets),
+                                 'payload_bytes': Histogram(byte_buckets), 'cache_hits': 0, 'cache_misses': 0, 'errors': 0}
+        return self.series[name]
+
+    def instrument(self, name, func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            ctx = _local.ctx = {'name': name, 'bytes_read': 0, 'hits': 0, 'misses': 0}
+            start, failed = time.time(), False
+            try:
+                return func(*args)
+            except Exception as e:
+                failed = type(e).__name__ != 'PreventUpdate' # dash's way of not updating the outputs, not an error
+                raise
+            finally:
+                seconds = time.time() - start
+                with self.lock:
+                    s = self._series(name)
+                    s['seconds'].observe(seconds) ; s['read_bytes'].observe(ctx['bytes_read'])
+                    s['cache_hits'] += ctx['hits'] ; s['cache_misses'] += ctx['misses'] ; s['errors'] += failed
+                    self.dirty = True
+                self._start_flusher()
+                if self.slow_ms is not None and seconds * 1e3 >= self.slow_ms:
+                    self.log.warning('slow callback %s: %.0f ms, %d bytes read, %d cache hits, %d misses, inputs %.200r',
+                                     name, seconds * 1e3, ctx['bytes_read'], ctx['hits'], ctx['misses'], args)
+                _local.ctx = None ; _local.last = name # for the payload size, measured once the response is built
+        return wrapper
+
+    def install(self, app):
+        register = app.callback
+        def callback(*args, **kwargs):
+            decorator = register(*args, **kwargs)
+            return lambda func: decorator(self.instrument(func.__name__, func))
+        app.callback = callback
+
+        @app.server.after_request
+        def record_payload(response):
+            name = getattr(_local, 'last', None)
+            if name is not None:
+                _local.last = None
+                with self.lock:
+                    self._series(name)['payload_bytes'].observe(response.calculate_content_length() or 0)
+                    self.dirty = True
+            return response
+
+        @app.server.route('/metrics')
+        def metrics():
+            return self.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+        return self
+
+    def _state(self):
+        return {name: {k: v.state() if isinstance(v, Histogram) else v for k, v in s.items()} for name, s in self.series.items()}
+
+    def _start_flusher(self):
+        # one flushing thread per process, started on its first callback: threads don't survive the fork of the workers
+        if self.shared_dir is None or self.flusher_pid == os.getpid(): return
+        with self.lock:
+            if self.flusher_pid == os.getpid(): return
+            self.flusher_pid = os.getpid()
+        def flush_forever():
+            while True:
+                time.sleep(self.flush_ms / 1e3)
+                self._save()
+        threading.Thread(target=flush_forever, name='metrics-flush', daemon=True).start()
+
+    def _save(self):
+        # this process's totals, for whichever process serves /metrics, if they changed since the last save. the
+        # state is copied under the lock and written outside it. best effort, like all of the instrumentation
+        if self.shared_dir is None: return
+        with self.lock:
+            if not self.dirty: return
+            state, self.dirty = json.dumps(self._state()), False
+        path = os.path.join(self.shared_dir, '{}.json'.format(os.getpid()))
+        with self.write_lock:
+            try:
+                with open(path + '.tmp', 'w') as f:
+                    f.write(state)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                pass
+
+    def totals(self):
+        # callback name -> metric -> state, summed over every process that shares shared_dir (or just this one)
+        if self.shared_dir is None:
+            with self.lock:
+                return json.loads(json.dumps(self._state()))
+        self._save() # this process's own file is then current
+        totals = {}
+        for f in sorted(os.listdir(self.shared_dir)):
+            if not f.endswith('.json'): continue
+            try:
+                with open(os.path.join(self.shared_dir, f)) as fp:
+                    state = json.load(fp)
+            except (OSError, ValueError):
+                continue
+            for name, series in state.items():
+                if name not in totals: totals[name] = series ; continue
+                totals[name] = {k: merge_states(totals[name][k], v) for k, v in series.items()}
+        return totals
+
+    def render(self):
+        out, totals = [], sorted(self.totals().items())
+        for metric, kind, buckets, help in [('seconds', 'histogram', time_buckets, 'wall time of the callback'),
+                                            ('read_bytes', 'histogram', byte_buckets, 'bytes read from the store by the callback'),
+                                            ('payload_bytes', 'histogram', byte_buckets, 'size of the JSON response of the callback'),
+                                            ('cache_hits', 'counter', None, 'figure/overlay cache hits'),
+                                            ('cache_misses', 'counter', None, 'figure/overlay cache misses'),
+                                            ('errors', 'counter', None, 'callbacks that raised')]:
+            name = 'dash_callback_' + metric + ('_total' if kind == 'counter' else '')
+            out += ['# HELP {} {}'.format(name, help), '# TYPE {} {}'.format(name, kind)]
+            for callback, s in totals:
+                labels = 'callback="{}"'.format(callback)
+                out += histogram_lines(name, labels, buckets, s[metric]) if kind == 'histogram' else ['{}{{{}}} {}'.format(name, labels, s[metric])]
+        return '\n'.join(out) + '\n'
@@ -0,0 +1,109 @@
+# Saliency overlays for the dashboard's frame viewer: rendered on demand, kept in an LRU cache,
+# and optionally pre-rendered offline into an h5 file of PNGs (python -m visualize_atari.overlays -h)
+
+from __future__ import print_function
+import os, json, argparse, base64
+from io import BytesIO
+
+import h5py
+import numpy as np
+import matplotlib as mpl ; mpl.use("Agg")
+import matplotlib.pyplot as plt
+
+from .cache import LRUCache
+from .store import open_dataset, export_stamp
+from .metrics import note_read, note_cache
+
+# Function from Greydanus to upscale saliency values into visible blots of blue/red
+def saliency_on_frame_abbr(S, frame, fudge_factor, sigma = 0, channel = 0):
+    S = fudge_factor * S / S.max()
+    I = frame.astype('uint16')
+    I[35:195,:,channel] += S.astype('uint16')
+    I = I.clip(1,255).astype('uint8')
+    return I
+
+def render_overlay(history, frame):
+    # PNG bytes of stored frame number frame (5 frame increments) of an episode, with actor saliency
+    # in blue and critic saliency in red. frames past the end of the episode are black
+    if frame >= len(history['ins']):
+        img = np.zeros((210,160,3), dtype='uint8')
+    else:
+        img = open_dataset(history, 'ins')[frame]
+        actor = open_dataset(history, 'actor_sal')[frame]; critic = open_dataset(history, 'critic_sal')[frame]
+        # Overlay saliency on frame
+        img = saliency_on_frame_abbr(actor, img, 500, 0, 2)
+        img = saliency_on_frame_abbr(critic, img, 500, 0 , 0)
+
+    buffer = BytesIO()
+    plt.imsave(buffer, img)
+    return buffer.getvalue()
+
+def to_data_uri(png):
+    return 'data:image/png;base64,{}'.format(base64.b64encode(png).decode())
+
+class OverlayCache():
+    # encoded overlays keyed on (snapshot, episode, frame). looks in an in-memory LRU first, then in the
+    # pre-rendered file (if any), and only renders the overlay from the store when both miss.
+    # history_of(snapshot, episode) returns the episode's group in the rollout store
+    def __init__(self, history_of, prebuilt_path=None, maxsize=4096):
+        self.history_of, self.prebuilt_path = history_of, prebuilt_path
+        self.lru = LRUCache(maxsize=maxsize)
+        self.prebuilt = h5py.File(prebuilt_path, 'r') if prebuilt_path else None
+        self.rendered = 0
+
+    def reopen(self):
+        # for forked server workers, which must not share HDF5 file handles
+        self.prebuilt = h5py.File(self.prebuilt_path, 'r') if self.prebuilt_path else None
+
+    def _build(self, snapshot, episode, frame):
+        history = self.history_of(snapshot, episode)
+        if self.prebuilt is not None and history.name in self.prebuilt:
+            pngs = self.prebuilt[history.name]
+            if frame < len(pngs):
+                png = pngs[frame].tobytes() ; note_read(len(png))
+                return to_data_uri(png)
+        self.rendered += 1
+        return to_data_uri(render_overlay(history, frame))
+
+    def get(self, snapshot, episode, frame):
+        key, built = (int(snapshot), int(episode), int(frame)), []
+        uri = self.lru.get_or_build(key, lambda: built.append(1) or self._build(*key))
+        note_cache(not built)
+        return uri
+
+    def stats(self):
+        stats = self.lru.stats() ; stats['rendered'] = self.rendered
+        return stats
+
+def build_overlays(store_path, dst_path):
+    # offline prewarm: render the overlay of every stored frame of every episode with saliency into dst_path,
+    # one variable-length dataset of PNGs per episode, at the same path as the episode in the store. every episode is
+    # stamped with the version of the store it was rendered from once complete, and rendered again if the store changed
+    stamp = json.dumps(export_stamp(store_path), sort_keys=True)
+    with h5py.File(store_path, 'r') as store, h5py.File(dst_path, 'a') as dst:
+        episodes = []
+        store.visititems(lambda name, obj: episodes.append(name) if isinstance(obj, h5py.Group) and
+                         all(k in obj for k in ['ins', 'actor_sal', 'critic_sal']) else None)
+        for name in episodes:
+            history = store[name] ; n = len(history['ins'])
+            if name in dst and dst[name].attrs.get('source') == stamp: continue # already built from this version
+            if name in dst: del dst[name]
+            pngs = dst.create_dataset(name, shape=(n,), dtype=h5py.vlen_dtype(np.uint8))
+            for frame in range(n):
+                pngs[frame] = np.frombuffer(render_overlay(history, frame), dtype=np.uint8)
+            pngs.attrs['source'] = stamp
+            print('rendered {} overlays of {}'.format(n, name))
+        dst.attrs['source'] = stamp
+
+def overlays_current(store_path, dst_path):
+    # whether dst_path holds the overlays of every episode of the store as it is now
+    if not os.path.exists(dst_path): return False
+    with h5py.File(dst_path, 'r') as dst:
+        return dst.attrs.get('source') == json.dumps(export_stamp(store_path), sort_keys=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pre-render saliency overlays for the dashboard frame viewer')
+    parser.add_argument('store', type=str, help='rollout store to read')
+    parser.add_argument('dst', type=str, help='h5 file to write the PNGs to (episodes already rendered from this version of the store are skipped)')
+    args = parser.parse_args()
+    build_overlays(args.store, args.dst)
@@ -0,0 +1,118 @@
+# Saliency aggregates stored next to each episode's rollout, so the dashboard can plot saliency by region
+# without loading the full actor_sal/critic_sal cubes
+
+from __future__ import print_function
+import os
+import numpy as np
+
+from .store import create_dataset, compressors, open_dataset
+from .cache import LRUCache
+
+region_labels = ['TopLeft', 'TopRight', 'BotLeft', 'BotRight']
+
+def quadrant_sums(frames, ymid=80, xmid=80):
+    # (T,H,W) saliency frames -> (T,4) saliency mass of the TopLeft, TopRight, BotLeft, BotRight quadrants
+    quadrants = [frames[:, :ymid, :xmid], frames[:, :ymid, xmid:], frames[:, ymid:, :xmid], frames[:, ymid:, xmid:]]
+    return np.stack([q.sum((1,2), dtype=np.float64) for q in quadrants], axis=1)
+
+def compute_aggregates(history, ymid=80, xmid=80, block=256):
+    # history: one episode (h5 group or dict) with actor_sal and critic_sal. reads block frames at a time
+    agg = {}
+    for k in ['actor', 'critic']:
+        sal = open_dataset(history, k + '_sal')
+        regions = np.concatenate([quadrant_sums(np.asarray(sal[i:i+block]), ymid, xmid) for i in range(0, sal.shape[0], block)]
+                                 or [np.zeros((0, 4))])
+        agg[k + '_regions'] = regions
+        agg[k + '_tot'] = regions.sum(1) # the quadrants tile the frame
+    return agg
+
+def write_aggregates(history, agg=None, ymid=80, xmid=80, compression='lzf'):
+    # (re)writes the history/aggregates group of one episode: {actor,critic}_tot (T,) and {actor,critic}_regions (T,4)
+    agg = compute_aggregates(history, ymid, xmid) if agg is None else agg
+    if 'aggregates' in history: del history['aggregates']
+    group = history.create_group('aggregates')
+    for k, v in agg.items():
+        create_dataset(group, k, v, compression)
+    group.attrs['ymid'], group.attrs['xmid'] = ymid, xmid
+    return group
+
+def load_aggregates(history):
+    # aggregates of one episode as numpy arrays, computed on the fly for stores that predate them
+    if 'aggregates' in history:
+        return {k: v[()] for k, v in history['aggregates'].items()}
+    if 'sat' in history:
+        agg = {}
+        for k in ['actor', 'critic']:
+            agg[k + '_regions'] = load_index(history, k).grid(2, 2).reshape(-1, 4)
+            agg[k + '_tot'] = agg[k + '_regions'].sum(1)
+        return agg
+    return compute_aggregates(history)
+
+#====================== Summed-area tables: saliency mass of any rectangle in O(1) per frame =================#
+
+sat_chunks = (64, 16, 16) # frames x rows x cols. corner lookups over a frame range only touch a few small chunks
+
+def summed_area_table(frames):
+    # (T,H,W) -> (T,H+1,W+1) integral images with a zero first row and column: sat[t,y,x] = frames[t,:y,:x].sum()
+    frames = np.asarray(frames)
+    sat = np.zeros((frames.shape[0], frames.shape[1]+1, frames.shape[2]+1))
+    sat[:, 1:, 1:] = frames.cumsum(1, dtype=np.float64).cumsum(2)
+    return sat
+
+def write_index(history, compression='lzf', block=256):
+    # (re)writes history/sat/{actor,critic}, the summed-area tables of actor_sal and critic_sal (kept in float64,
+    # since region sums are differences of large numbers), block frames at a time
+    if 'sat' in history: del history['sat']
+    group = history.create_group('sat')
+    for k in ['actor', 'critic']:
+        sal = open_dataset(history, k + '_sal') ; T, H, W = sal.shape
+        layout = dict(chunks=tuple(min(c, n) for c, n in zip(sat_chunks, (max(T, 1), H+1, W+1))))
+        if compression != 'none': layout.update(compressors[compression])
+        ds = group.create_dataset(k, shape=(T, H+1, W+1), dtype=np.float64, **layout)
+        for i in range(0, T, block):
+            ds[i:i+block] = summed_area_table(sal[i:i+block])
+    return group
+
+class SaliencyIndex():
+    # region queries against the summed-area table of one episode's saliency (an h5 dataset or an array).
+    # rows y0:y1 and columns x0:x1 follow python slice conventions on the (H,W) saliency frame
+    def __init__(self, sat):
+        self.sat = sat
+        self.shape = (sat.shape[0], sat.shape[1]-1, sat.shape[2]-1) # (T,H,W) of the saliency frames
+
+    def rect(self, y0, y1, x0, x1, frames=slice(None)):
+        # saliency mass of one rectangle for every frame in frames
+        s = self.sat
+        return s[frames, y1, x1] - s[frames, y0, x1] - s[frames, y1, x0] + s[frames, y0, x0]
+
+    def grid(self, ny, nx, frames=slice(None)):
+        # (T,ny,nx) saliency mass of an ny x nx grid of (nearly) equal regions, row-major from the top left
+        ys = np.linspace(0, self.shape[1], ny+1).round().astype(int)
+        xs = np.linspace(0, self.shape[2], nx+1).round().astype(int)
+        corners = np.asarray(self.sat[frames, ys, :])[:, :, xs] # only reads the ny+1 corner rows of each frame
+        return np.diff(np.diff(corners, axis=1), axis=2)
+
+    def total(self, frames=slice(None)):
+        return self.rect(0, self.shape[1], 0, self.shape[2], frames)
+
+_index_cache = LRUCache(maxsize=16, max_bytes=512 << 20, sizeof=lambda index: index.sat.nbytes)
+
+def _source_of(history):
+    # the file (or export directory) an episode was read from, for cache keys. None for in-memory episodes
+    for source in [lambda h: h.file.filename, lambda h: h.store.path, lambda h: h.store.root]:
+        try:
+            return source(history)
+        except AttributeError:
+            pass
+    return None
+
+def load_index(history, kind='critic'):
+    # SaliencyIndex for kind ('actor' or 'critic') of one episode. for stores without sat tables it is built in memory,
+    # which reads the whole saliency cube, so it is kept in a small LRU cache
+    if 'sat' in history:
+        return SaliencyIndex(history['sat'][kind])
+    build = lambda: SaliencyIndex(summed_area_table(open_dataset(history, kind + '_sal')[()]))
+    source = _source_of(history)
+    if source is None: return build()
+    stamp = os.path.getmtime(source) if os.path.exists(source) else None # a rewritten store gets new entries
+    return _index_cache.get_or_build((source, stamp, history.name, kind), build)
@@ -10,10 +10,50 @@ import torch.nn.functional as F
 
 import numpy as np
 from scipy.misc import imresize # preserves single-pixel info _unlike_ img = img[::2,::2]
+from .store import dataset_layout
 
 prepro = lambda img: imresize(img[35:195].mean(2), (80,80)).astype(np.float32).reshape(1,80,80)/255.
 
-def rollout(model, env, max_ep_len=3e3, render=False):
+class RolloutWriter():
+    # streams rollout steps into resizable datasets of an h5py group, so memory stays flat however long the episode.
+    # at most buffer_size steps are held in memory before they are appended to the datasets. strides keeps only every
+    # n-th step of a key (e.g. {'ins': 5} stores frames 0, 5, 10...). encoders maps keys to store.FrameEncoders that
+    # encode them on the way (e.g. {'ins': FrameEncoder()}). the group is flagged 'partial' until close()
+    def __init__(self, group, strides={}, buffer_size=100, compression='lzf', encoders={}):
+        self.group, self.strides, self.buffer_size, self.compression = group, strides, buffer_size, compression
+        self.encoders = encoders
+        self.buffers, self.steps = {}, 0
+        self.group.attrs['partial'] = True
+
+    def append(self, step):
+        for k, v in step.items():
+            if self.steps % self.strides.get(k, 1) == 0:
+                self.buffers.setdefault(k, []).append(np.asarray(v))
+        self.steps += 1
+        if self.steps % self.buffer_size == 0: self.flush()
+
+    def flush(self):
+        for k, buf in self.buffers.items():
+            if len(buf) == 0: continue
+            data = np.stack(buf, axis=0)
+            if k in self.encoders: data = self.encoders[k].encode(data)
+            if k not in self.group:
+                ds = self.group.create_dataset(k, data=data, **dataset_layout(data.shape, data.dtype, self.compression))
+                ds.attrs['stride'] = self.strides.get(k, 1)
+            else:
+                ds = self.group[k] ; n = ds.shape[0]
+                ds.resize(n + data.shape[0], axis=0) ; ds[n:] = data
+            self.buffers[k] = []
+
+    def close(self):
+        self.flush()
+        for k, encoder in self.encoders.items():
+            if k in self.group: encoder.finish(self.group, k)
+        del self.group.attrs['partial']
+        return self.group
+
+def rollout(model, env, max_ep_len=3e3, render=False, writer=None):
+    # with a RolloutWriter every step is streamed to it and the (closed) writer's group is returned instead of the history
     history = {'ins': [], 'logits': [], 'values': [], 'outs': [], 'hx': [], 'reward':[]}
     
     state = torch.Tensor(prepro(env.reset())) # get first state
@@ -25,7 +65,8 @@ def rollout(model, env, max_ep_len=3e3, render=False):
         episode_length += 1
         #value, logit, (hx, cx) = model((Variable(state.view(1,1,80,80)), (hx, cx)))
         #hx, cx = Variable(hx.data), Variable(cx.data)
-        value, logit, hx = model((Variable(state.view(1,1,80,80)), hx))
+        with torch.no_grad(): # no graph chaining every step through hx, so memory stays flat however long the episode
+            value, logit, hx = model((Variable(state.view(1,1,80,80)), hx))
         #hx, cx = Variable(hx.data), Variable(cx.data)
         
         prob = F.softmax(logit)
@@ -36,13 +77,57 @@ def rollout(model, env, max_ep_len=3e3, render=False):
         state = torch.Tensor(prepro(obs)) ; epr += reward
 
         # save info!
-        history['ins'].append(obs)
-        history['hx'].append(hx.squeeze(0).data.numpy())
-        #history['cx'].append(cx.squeeze(0).data.numpy())
-        history['logits'].append(logit.data.numpy()[0])
-        history['values'].append(value.data.numpy()[0])
-        history['outs'].append(prob.data.numpy()[0])
-        history['reward'].append(reward)
+        step = {'ins': obs,
+                'hx': hx.squeeze(0).data.numpy(),
+                #'cx': cx.squeeze(0).data.numpy(),
+                'logits': logit.data.numpy()[0],
+                'values': value.data.numpy()[0],
+                'outs': prob.data.numpy()[0],
+                'reward': reward}
+        if writer is None:
+            for k, v in step.items(): history[k].append(v)
+        else:
+            writer.append(step)
         print('\tstep # {}, reward {:.0f}'.format(episode_length, epr), end='\r')
 
-    return history
+    return history if writer is None else writer.close()
+
+def rollout_vec(model, envs, max_ep_len=3e3, render=False, writers=None):
+    # steps all envs in lockstep with one batched forward pass per step. envs that finish drop out of the batch.
+    # returns one history per env in the same layout as rollout() (or the closed writers' groups if writers are given)
+    histories = [{'ins': [], 'logits': [], 'values': [], 'outs': [], 'hx': [], 'reward':[]} for env in envs]
+    states = torch.Tensor(np.stack([prepro(env.reset()) for env in envs])) # get first states
+    hx = torch.zeros(len(envs), 256)
+    episode_length, epr = 0, np.zeros(len(envs)) # bookkeeping
+    active = list(range(len(envs)))
+
+    while len(active) and episode_length <= max_ep_len:
+        episode_length += 1
+        with torch.no_grad():
+            value, logit, hx_active = model((states[active], hx[active]))
+        prob = F.softmax(logit, dim=1)
+        actions = prob.max(1)[1].numpy()
+        hx[active] = hx_active
+
+        still_active = []
+        for row, i in enumerate(active):
+            obs, reward, done, expert_policy = envs[i].step(actions[row])
+            if render: envs[i].render()
+            states[i] = torch.Tensor(prepro(obs)) ; epr[i] += reward
+
+            # save info!
+            step = {'ins': obs,
+                    'hx': hx_active[row].numpy().copy(),
+                    'logits': logit[row].numpy().copy(),
+                    'values': value[row].numpy().copy(),
+                    'outs': prob[row].numpy().copy(),
+                    'reward': reward}
+            if writers is None:
+                for k, v in step.items(): histories[i][k].append(v)
+            else:
+                writers[i].append(step)
+            if not done: still_active.append(i)
+        active = still_active
+        print('\tstep # {}, {} envs running, rewards {}'.format(episode_length, len(active), epr.astype(int)), end='\r')
+
+    return histories if writers is None else [writer.close() for writer in writers]
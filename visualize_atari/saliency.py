@@ -8,12 +8,28 @@ from torch.autograd import Variable
 import torch.nn.functional as F
 
 import numpy as np
+from collections import OrderedDict
+from functools import partial
 from scipy.ndimage.filters import gaussian_filter
 from scipy.misc import imresize # preserves single-pixel info _unlike_ img = img[::2,::2]
 
 prepro = lambda img: imresize(img[35:195].mean(2), (80,80)).astype(np.float32).reshape(1,80,80)/255.
-searchlight = lambda I, mask: I*mask + gaussian_filter(I, sigma=3)*(1-mask) # choose an area NOT to blur
-occlude = lambda I, mask: I*(1-mask) + gaussian_filter(I, sigma=3)*mask # choose an area to blur
+searchlight = lambda I, mask: I*mask + blur_frame(I)*(1-mask) # choose an area NOT to blur
+occlude = lambda I, mask: I*(1-mask) + blur_frame(I)*mask # choose an area to blur
+# both also accept a stack of masks with shape (N,80,80) and then return all N perturbations at once
+
+_blur_cache = OrderedDict() # frame -> blurred frame, most recently used last
+_mask_bank = {} # (radius, density, size) -> (centers, masks), built once per process
+
+def blur_frame(I, sigma=3, cache_size=64):
+    # the blurred frame is the same for every mask on that frame, so only blur it once
+    key = (I.tobytes(), I.shape, sigma)
+    if key in _blur_cache:
+        _blur_cache.move_to_end(key)
+        return _blur_cache[key]
+    _blur_cache[key] = B = gaussian_filter(I, sigma=sigma)
+    if len(_blur_cache) > cache_size: _blur_cache.popitem(last=False)
+    return B
 
 def get_mask(center, size, r):
     y,x = np.ogrid[-center[0]:size[0]-center[0], -center[1]:size[1]-center[1]]
@@ -22,6 +38,15 @@ def get_mask(center, size, r):
     mask = gaussian_filter(mask, sigma=r) # blur the circle of pixels. this is a 2D Gaussian for r=r^2=1
     return mask/mask.max()
 
+def get_mask_bank(r, d, size=[80,80]):
+    # all masks of a d-spaced grid as one (N,size[0],size[1]) array, plus the grid centers they belong to
+    key = (r, d, tuple(size))
+    if key not in _mask_bank:
+        centers = [(i,j) for i in range(0,size[0],d) for j in range(0,size[1],d)]
+        masks = np.stack([get_mask(center=c, size=size, r=r) for c in centers]).astype(np.float32)
+        _mask_bank[key] = (centers, masks)
+    return _mask_bank[key]
+
 def run_through_model(model, history, ix, interp_func=None, mask=None, blur_memory=None, mode='actor'):
     if mask is None:
         im = prepro(history['ins'][ix])
@@ -36,23 +61,233 @@ def run_through_model(model, history, ix, interp_func=None, mask=None, blur_memo
     #return model((state, (hx, cx)))[0] if mode == 'critic' else model((state, (hx, cx)))[1]
     return model((state, hx))[0] if mode == 'critic' else model((state, hx))[1]
 
-def score_frame(model, history, ix, r, d, interp_func, mode='actor'):
-    # r: radius of blur
-    # d: density of scores (if d==1, then get a score for every pixel...
-    #    if d==2 then every other, which is 25% of total pixels for a 2D image)
-    assert mode in ['actor', 'critic'], 'mode must be either "actor" or "critic"'
-    L = run_through_model(model, history, ix, interp_func, mask=None, mode=mode)
-    scores = np.zeros((int(80/d)+1,int(80/d)+1)) # saliency scores S(t,i,j)
-    for i in range(0,80,d):
-        for j in range(0,80,d):
-            mask = get_mask(center=[i,j], size=[80,80], r=r)
-            l = run_through_model(model, history, ix, interp_func, mask=mask, mode=mode)
-            #scores[int(i/d),int(j/d)] = (L-l).pow(2).sum().mul_(.5).data[0]
-            scores[int(i/d),int(j/d)] = (L-l).pow(2).sum().mul_(.5).item()
+def run_through_model_batch(model, history, ix, interp_func, masks, mode='actor', batch_size=256):
+    # same as run_through_model, but every perturbed input I' (and a copy of hx for each) is stacked into
+    # batches of up to batch_size. row 0 of the output is always the unperturbed input I.
+    # mode='both' returns (actor, critic) outputs from the same forward passes
+    I = prepro(history['ins'][ix]).squeeze()
+    ims = np.concatenate([I[None], interp_func(I, np.asarray(masks))]).astype(np.float32).reshape(-1,1,80,80)
+    hx = torch.Tensor(history['hx'][ix*5-1]).view(1,-1)
+    values, logits = [], []
+    with torch.no_grad():
+        for k in range(0, len(ims), batch_size):
+            state = torch.from_numpy(ims[k:k+batch_size])
+            value, logit, _ = model((state, hx.repeat(state.size(0), 1)))
+            values.append(value) ; logits.append(logit)
+    values, logits = torch.cat(values, 0), torch.cat(logits, 0)
+    if mode == 'both':
+        return logits, values
+    return values if mode == 'critic' else logits
+
+def _perturbation_scores(out):
+    L, l = out[:1], out[1:]
+    return (L-l).pow(2).sum(1).mul_(.5).numpy() # one score per mask
+
+def _scores_to_map(scores):
     pmax = scores.max()
     scores = imresize(scores, size=[80,80], interp='bilinear').astype(np.float32)
     return pmax * scores / scores.max()
 
+def _perturbation_map(out, centers, d):
+    scores = np.zeros((int(80/d)+1,int(80/d)+1)) # saliency scores S(t,i,j)
+    for (i,j), s in zip(centers, _perturbation_scores(out)):
+        scores[int(i/d),int(j/d)] = s
+    return _scores_to_map(scores)
+
+def score_frame(model, history, ix, r, d, interp_func, mode='actor', batch_size=256):
+    # r: radius of blur
+    # d: density of scores (if d==1, then get a score for every pixel...
+    #    if d==2 then every other, which is 25% of total pixels for a 2D image)
+    # batch_size: number of perturbed inputs per forward pass (batch_size=1 is one pass per mask)
+    # mode='both' returns (actor_saliency, critic_saliency) for the cost of a single mode
+    assert mode in ['actor', 'critic', 'both'], 'mode must be "actor", "critic" or "both"'
+    centers, masks = get_mask_bank(r, d)
+    out = run_through_model_batch(model, history, ix, interp_func, masks, mode=mode, batch_size=batch_size)
+    if mode == 'both':
+        return tuple(_perturbation_map(o, centers, d) for o in out)
+    return _perturbation_map(out, centers, d)
+
+def score_frame_adaptive(model, history, ix, r, d, interp_func, mode='actor', coarse=4, threshold=0.1, topk=None,
+                         batch_size=256, report=False, compare=False):
+    # coarse-to-fine version of score_frame: the d-spaced grid is split into cells of coarse x coarse points, and each
+    # cell is first scored at the point nearest its centre. then every point is scored inside the cells whose score
+    # is >= threshold*max (or the topk best cells) and inside their neighbours, since a salient object near a cell's
+    # edge mostly shows up in the next cell's probe. points that are not refined inherit the score of their cell.
+    # report=True also returns a dict with the number of forward passes used and saved. compare=True adds
+    # the error against the dense score_frame map (which costs a full dense pass, so only use it to tune)
+    assert mode in ['actor', 'critic', 'both'], 'mode must be "actor", "critic" or "both"'
+    names = ['actor', 'critic'] if mode == 'both' else [mode]
+    centers, masks = get_mask_bank(r, d)
+    grid = np.array(centers) // d # grid row and column of every mask
+    n = grid.max() + 1 ; m = -(-n // coarse) # grid points and cells per side
+    cell = grid // coarse
+    cell_ids = cell[:,0]*m + cell[:,1]
+    is_probe = (grid == np.minimum(cell*coarse + coarse//2, n-1)).all(1) # the point nearest the centre of its cell
+    probe_of = np.zeros(m*m, dtype=int) ; probe_of[cell_ids[is_probe]] = np.where(is_probe)[0]
+    scores = np.zeros((len(names), len(centers)))
+
+    def run(ixs):
+        out = run_through_model_batch(model, history, ix, interp_func, masks[ixs], mode=mode, batch_size=batch_size)
+        scores[:, ixs] = np.stack([_perturbation_scores(o) for o in (out if mode == 'both' else (out,))])
+
+    probe_ixs = probe_of ; run(probe_ixs)
+    cell_scores = scores[:, probe_ixs] / np.maximum(scores[:, probe_ixs].max(1, keepdims=True), 1e-30)
+    cell_scores = cell_scores.max(0) # in 'both' mode a cell is refined if either head finds it salient
+    keep = np.argsort(-cell_scores)[:topk] if topk is not None else np.where(cell_scores >= threshold)[0]
+    hot = np.zeros((m+2, m+2), dtype=bool) ; hot[1:-1, 1:-1].flat[keep] = True
+    near = np.zeros((m, m), dtype=bool) # salient cells and their 8 neighbours
+    for di in range(3):
+        for dj in range(3): near |= hot[di:di+m, dj:dj+m]
+    refine = near.reshape(-1)[cell_ids]
+    fine_ixs = np.where(refine & ~is_probe)[0]
+    if len(fine_ixs): run(fine_ixs)
+    inherit = np.where(~refine & ~is_probe)[0]
+    scores[:, inherit] = scores[:, probe_of[cell_ids[inherit]]]
+
+    maps = []
+    for h in range(len(names)):
+        S = np.zeros((int(80/d)+1,int(80/d)+1))
+        S[grid[:,0], grid[:,1]] = scores[h]
+        maps.append(_scores_to_map(S))
+    result = tuple(maps) if mode == 'both' else maps[0]
+    if not (report or compare):
+        return result
+
+    stats = {'passes': len(probe_ixs) + len(fine_ixs) + (2 if len(fine_ixs) else 1), 'dense_passes': len(centers) + 1,
+             'coarse_cells': len(probe_ixs), 'salient_cells': len(keep), 'refined_cells': int(near.sum())}
+    stats['saved_passes'] = stats['dense_passes'] - stats['passes']
+    if compare:
+        dense = score_frame(model, history, ix, r, d, interp_func, mode=mode, batch_size=batch_size)
+        for name, M, D in zip(names, maps, dense if mode == 'both' else (dense,)):
+            stats[name + '_max_error'] = float(np.abs(M - D).max())
+            stats[name + '_rel_error'] = float(np.linalg.norm(M - D) / max(np.linalg.norm(D), 1e-30))
+    return result, stats
+
+class IncrementalSaliency():
+    # perturbation saliency for consecutive frames of one episode. a mask is only re-scored if the preprocessed
+    # input under its support (mask > support) moved by more than tol, or the unperturbed outputs (actor logits and
+    # critic value) moved by more than out_tol of their norm, since that mask was last scored; otherwise its old score
+    # is reused. the outputs stand in for the hidden state, which itself moves by O(1) between scored frames even when
+    # the policy's response does not. hits/misses count reused/re-scored masks
+    def __init__(self, model, r, d, interp_func, tol=2e-2, out_tol=0.2, support=1e-2, batch_size=256):
+        self.model, self.d, self.interp_func, self.batch_size = model, d, interp_func, batch_size
+        self.tol, self.out_tol = tol, out_tol
+        self.centers, self.masks = get_mask_bank(r, d)
+        self.support = (self.masks > support).reshape(len(self.masks), -1)
+        self.reset()
+
+    def reset(self): # call between episodes
+        self.ref_I = self.ref_out = self.scores = None
+        self.hits, self.misses = 0, 0
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def score(self, history, ix, mode='both'):
+        assert mode in ['actor', 'critic', 'both'], 'mode must be "actor", "critic" or "both"'
+        I = prepro(history['ins'][ix]).reshape(-1)
+        logits, values = run_through_model_batch(self.model, history, ix, self.interp_func, self.masks[:0], mode='both')
+        out = torch.cat([logits[0], values[0]]).numpy() # unperturbed outputs only: one forward pass
+        if self.scores is None:
+            stale = np.ones(len(self.masks), dtype=bool)
+            self.ref_I, self.ref_out = np.tile(I, (len(self.masks), 1)), np.tile(out, (len(self.masks), 1))
+            self.scores = np.zeros((2, len(self.masks)))
+        else:
+            moved = (np.abs(self.ref_I - I) > self.tol) & self.support
+            drift = np.linalg.norm(self.ref_out - out, axis=1) / max(np.linalg.norm(out), 1e-6)
+            stale = moved.any(1) | (drift > self.out_tol)
+        ixs = np.where(stale)[0]
+        if len(ixs):
+            outs = run_through_model_batch(self.model, history, ix, self.interp_func, self.masks[ixs], mode='both',
+                                           batch_size=self.batch_size)
+            self.scores[:, ixs] = np.stack([_perturbation_scores(o) for o in outs])
+            self.ref_I[ixs], self.ref_out[ixs] = I, out
+        self.misses += len(ixs) ; self.hits += len(self.masks) - len(ixs)
+
+        maps = []
+        for h in range(2):
+            S = np.zeros((int(80/self.d)+1,int(80/self.d)+1))
+            for (i,j), v in zip(self.centers, self.scores[h]):
+                S[int(i/self.d),int(j/self.d)] = v
+            maps.append(_scores_to_map(S))
+        return tuple(maps) if mode == 'both' else maps[0 if mode == 'actor' else 1]
+
+def _episode_inputs(history, ixs):
+    ims = np.stack([prepro(history['ins'][ix]) for ix in ixs]) # (T,1,80,80)
+    hx = np.stack([history['hx'][ix*5-1] for ix in ixs]) # same hx convention as run_through_model
+    return torch.Tensor(ims), torch.Tensor(hx)
+
+def _input_gradients(model, ims, hx, actions):
+    # d(actor logit of the chosen action)/dI and d(critic value)/dI for a whole batch of frames
+    state = ims.clone().requires_grad_(True)
+    value, logit, _ = model((state, hx))
+    actor_grad, = torch.autograd.grad(logit.gather(1, actions).sum(), state, retain_graph=True)
+    critic_grad, = torch.autograd.grad(value.sum(), state)
+    return actor_grad, critic_grad
+
+def gradient_saliency(model, history, ixs, method='jacobian', steps=20, batch_size=64):
+    # gradient-based alternative to score_frame that works on many frames per pass. returns
+    # (actor_saliency, critic_saliency), each with shape (len(ixs),80,80)
+    #  jacobian:     |dF/dI|
+    #  grad_x_input: |I * dF/dI|
+    #  integrated:   |(I-B) * mean dF/dI| along the straight path from the blurred frame B to I (steps points)
+    assert method in ['jacobian', 'grad_x_input', 'integrated'], 'unknown gradient method "{}"'.format(method)
+    ixs = list(ixs) ; actor_maps, critic_maps = [], []
+    for k in range(0, len(ixs), batch_size):
+        ims, hx = _episode_inputs(history, ixs[k:k+batch_size])
+        with torch.no_grad():
+            actions = model((ims, hx))[1].max(1)[1].view(-1,1) # explain the greedy action at the unperturbed frame
+        if method == 'integrated':
+            base = torch.Tensor(np.stack([blur_frame(im.squeeze()) for im in ims.numpy()])).view_as(ims)
+            a, c = torch.zeros_like(ims), torch.zeros_like(ims)
+            for alpha in (np.arange(steps) + .5) / steps:
+                da, dc = _input_gradients(model, base + alpha*(ims - base), hx, actions)
+                a += da/steps ; c += dc/steps
+            a, c = a*(ims - base), c*(ims - base)
+        else:
+            a, c = _input_gradients(model, ims, hx, actions)
+            if method == 'grad_x_input':
+                a, c = a*ims, c*ims
+        actor_maps.append(a.abs().squeeze(1).numpy()) ; critic_maps.append(c.abs().squeeze(1).numpy())
+    return np.concatenate(actor_maps).astype(np.float32), np.concatenate(critic_maps).astype(np.float32)
+
+def perturbation_saliency(model, history, ixs, r=5, d=5, interp_func=None, batch_size=256):
+    interp_func = occlude if interp_func is None else interp_func
+    maps = [score_frame(model, history, ix, r, d, interp_func, mode='both', batch_size=batch_size) for ix in ixs]
+    return np.stack([m[0] for m in maps]), np.stack([m[1] for m in maps])
+
+def incremental_saliency(model, history, ixs, r=5, d=5, interp_func=None, batch_size=256, tol=2e-2, out_tol=0.2):
+    scorer = IncrementalSaliency(model, r, d, occlude if interp_func is None else interp_func, tol=tol, out_tol=out_tol,
+                                 batch_size=batch_size)
+    maps = [scorer.score(history, ix) for ix in ixs]
+    print('\tincremental saliency reused {:.1f}% of mask scores'.format(100*scorer.hit_rate()))
+    return np.stack([m[0] for m in maps]), np.stack([m[1] for m in maps])
+
+def adaptive_saliency(model, history, ixs, r=5, d=5, interp_func=None, batch_size=256, coarse=4, threshold=0.1, topk=None):
+    interp_func = occlude if interp_func is None else interp_func
+    maps, passes, dense_passes = [], 0, 0
+    for ix in ixs:
+        m, stats = score_frame_adaptive(model, history, ix, r, d, interp_func, mode='both', coarse=coarse,
+                                        threshold=threshold, topk=topk, batch_size=batch_size, report=True)
+        maps.append(m) ; passes += stats['passes'] ; dense_passes += stats['dense_passes']
+    print('\tadaptive saliency used {} of {} forward passes ({:.1f}% saved)'.format(
+        passes, dense_passes, 100 * (1 - passes / max(dense_passes, 1))))
+    return np.stack([m[0] for m in maps]), np.stack([m[1] for m in maps])
+
+# pluggable saliency backends: each maps (model, history, frame indices, **kwargs) -> (actor_saliency, critic_saliency)
+saliency_backends = {
+    'perturbation': perturbation_saliency,
+    'adaptive': adaptive_saliency,
+    'incremental': incremental_saliency,
+    'jacobian': partial(gradient_saliency, method='jacobian'),
+    'grad_x_input': partial(gradient_saliency, method='grad_x_input'),
+    'integrated': partial(gradient_saliency, method='integrated'),
+}
+
+def score_frames(model, history, ixs, method='perturbation', **kwargs):
+    assert method in saliency_backends, 'method must be one of {}'.format(sorted(saliency_backends))
+    return saliency_backends[method](model, history, ixs, **kwargs)
+
 def saliency_on_atari_frame(saliency, atari, fudge_factor, channel=2, sigma=0):
     # sometimes saliency maps are a bit clearer if you blur them
     # slightly...sigma adjusts the radius of that blur
@@ -0,0 +1,418 @@
+# Storage helpers for the h5 rollout store written by generate_data.py and read by app.py
+
+from __future__ import print_function
+import os, argparse, json, shutil
+import numpy as np
+import h5py
+
+# compression filters usable for store datasets. lzf ships with h5py and is the fast default;
+# blosc/zstd need the optional hdf5plugin package (which readers then also need to have installed)
+compressors = {'none': {}, 'lzf': dict(compression='lzf'), 'gzip': dict(compression='gzip', compression_opts=4)}
+try:
+    import hdf5plugin
+    compressors['blosc'] = hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE)
+    compressors['zstd'] = hdf5plugin.Zstd(clevel=3)
+except ImportError:
+    pass
+
+chunk_bytes = 1 << 16 # target size of the chunks of per-step data (rewards, logits, hx...)
+
+def dataset_layout(shape, dtype, compression='lzf'):
+    # create_dataset kwargs for a store dataset. frame-like data (3+ dims: ins, saliency) gets one chunk per frame,
+    # so a single frame can be read without decompressing its neighbours. per-step vectors are chunked in runs of
+    # frames of about chunk_bytes. the leading axis is always resizable so streamed rollouts can grow
+    assert compression in compressors, 'compression must be one of {}'.format(sorted(compressors))
+    shape = tuple(shape)
+    if len(shape) >= 3:
+        chunks = (1,) + shape[1:]
+    else:
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape[1:]))
+        chunks = (max(1, chunk_bytes // row_bytes),) + shape[1:]
+    layout = dict(chunks=chunks, maxshape=(None,) + shape[1:])
+    layout.update(compressors[compression])
+    if compression not in ['none', 'blosc'] and len(shape) < 3: layout['shuffle'] = True # blosc shuffles itself
+    return layout
+
+def create_dataset(group, name, data, compression='lzf'):
+    data = np.asarray(data)
+    return group.create_dataset(name, data=data, **dataset_layout(data.shape, data.dtype, compression))
+
+#====================== Quantized saliency: uint8/float16 maps with a per-frame scale and offset ======================#
+
+quant_levels = {'uint8': 255, 'float16': 1} # values per unit of scale
+
+def quantize(frames, dtype='uint8'):
+    # (T,...) float frames -> (q, scale, offset) with frames ~= q*scale + offset, scale and offset (T,) float32.
+    # each frame is mapped onto its own [min, max] range, so faint and bright frames keep the same relative precision
+    frames = np.asarray(frames, dtype=np.float32)
+    axes = tuple(range(1, frames.ndim))
+    offset = frames.min(axes) if frames.size else np.zeros(frames.shape[:1], np.float32)
+    scale = ((frames.max(axes) if frames.size else offset) - offset) / quant_levels[dtype]
+    scale[scale == 0] = 1
+    q = (frames - _per_frame(offset, frames)) / _per_frame(scale, frames)
+    q = np.rint(q) if dtype == 'uint8' else q
+    return q.astype(dtype), scale.astype(np.float32), offset.astype(np.float32)
+
+def _per_frame(v, frames):
+    v = np.asarray(v)
+    return v.reshape(v.shape + (1,) * (frames.ndim - v.ndim))
+
+def dequantize(q, scale, offset):
+    return q.astype(np.float32) * _per_frame(scale, q) + _per_frame(offset, q)
+
+class Dequantized():
+    # read-only view of a quantized dataset (h5py, lazy or memmapped) that dequantizes the rows it is indexed with
+    def __init__(self, data, scale, offset):
+        self.data, self.scale, self.offset = data, scale, offset
+        self.shape, self.dtype, self.name = data.shape, np.dtype(np.float32), getattr(data, 'name', None)
+        self.attrs = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[()], dtype)
+
+    def __getitem__(self, idx):
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        rows = idx[0] if idx and idx[0] is not Ellipsis else slice(None)
+        return dequantize(np.asarray(self.data[idx]), np.asarray(self.scale[rows]), np.asarray(self.offset[rows]))
+
+def decoded(data, attrs, sibling):
+    # view of a store dataset (h5py, lazy or memmapped) that undoes its storage encoding, see write_saliency and
+    # encode_frames. sibling(suffix) opens the companion dataset named like data with suffix appended
+    if 'quantized' in attrs:
+        return Dequantized(data, sibling('_scale'), sibling('_offset'))
+    if attrs.get('codec') == 'palette-xor':
+        return PaletteFrames(data, np.asarray(sibling('_palette')[()]), int(attrs['keyframe_interval']))
+    return data
+
+def open_dataset(group, name):
+    # dataset name of group, decoded on read if it was stored quantized or palette/delta encoded
+    ds = group[name]
+    if isinstance(ds, (Dequantized, PaletteFrames)): return ds
+    return decoded(ds, getattr(ds, 'attrs', {}), lambda suffix: group[name + suffix])
+
+def quantize_report(frames, q, scale, offset):
+    # storage saved and reconstruction error of quantizing frames into (q, scale, offset)
+    frames = np.asarray(frames, dtype=np.float32)
+    error = np.abs(dequantize(q, scale, offset) - frames)
+    ranges = _per_frame(np.maximum(scale * quant_levels[str(q.dtype)], 1e-12), frames) # each frame's max - min
+    return {'raw_bytes': frames.nbytes, 'stored_bytes': q.nbytes + scale.nbytes + offset.nbytes,
+            'max_error': float(error.max()) if error.size else 0., 'max_rel_error': float((error / ranges).max()) if error.size else 0.}
+
+def merge_reports(reports):
+    merged = {'raw_bytes': 0, 'stored_bytes': 0, 'max_error': 0., 'max_rel_error': 0.}
+    for r in reports:
+        merged.update({k: merged[k] + r[k] for k in ['raw_bytes', 'stored_bytes']})
+        merged.update({k: max(merged[k], r[k]) for k in ['max_error', 'max_rel_error']})
+    return merged
+
+def format_report(report):
+    return '{:.1f} MB -> {:.1f} MB uncompressed ({:.1f}x), max error {:.3g} ({:.2%} of the frame range)'.format(
+        report['raw_bytes'] / 1e6, report['stored_bytes'] / 1e6, report['raw_bytes'] / max(report['stored_bytes'], 1),
+        report['max_error'], report['max_rel_error'])
+
+def write_saliency(group, name, frames, compression='lzf', quantization='none'):
+    # (re)writes saliency frames as group/name, quantized to uint8 or float16 with group/name_scale and
+    # group/name_offset alongside when quantization is not 'none'. returns a quantize_report (None if not quantized)
+    for k in [name, name + '_scale', name + '_offset']:
+        if k in group: del group[k]
+    if quantization == 'none':
+        create_dataset(group, name, frames, compression) ; return None
+    q, scale, offset = quantize(frames, quantization)
+    create_dataset(group, name, q, compression).attrs['quantized'] = quantization
+    create_dataset(group, name + '_scale', scale, compression)
+    create_dataset(group, name + '_offset', offset, compression)
+    return quantize_report(frames, q, scale, offset)
+
+#====================== Frame codec: palette indices, XORed against a keyframe every keyframe_interval frames ===========#
+# Atari screens use few colors and change little between frames, so the XOR of a frame with its keyframe is mostly
+# zeros and compresses very well. any frame decodes from two reads: itself and its keyframe
+
+keyframe_interval = 32
+
+def _color_codes(frames):
+    f = np.asarray(frames).astype(np.uint32)
+    return (f[..., 0] << 16) | (f[..., 1] << 8) | f[..., 2]
+
+def frame_palette(frames, palette=None):
+    # (P,3) uint8 palette of the colors of (...,3) uint8 frames. append-only: new colors are added after the
+    # colors of palette, so indices into palette stay valid
+    palette = np.zeros((0, 3), np.uint8) if palette is None else palette
+    new = np.setdiff1d(np.unique(_color_codes(frames)), _color_codes(palette))
+    if len(palette) + len(new) > 256:
+        raise ValueError('frames have more than 256 colors, they cannot be palette-indexed')
+    new = np.stack([(new >> 16) & 255, (new >> 8) & 255, new & 255], axis=1).astype(np.uint8)
+    return np.concatenate([palette, new])
+
+def palette_indices(frames, palette):
+    codes = _color_codes(palette) ; order = np.argsort(codes)
+    return order[np.searchsorted(codes[order], _color_codes(frames))].astype(np.uint8)
+
+class PaletteFrames():
+    # read-only view of frames stored by encode_frames, decoding the rows it is indexed with back to (...,3) uint8 RGB
+    def __init__(self, data, palette, interval):
+        self.data, self.palette, self.interval = data, palette, interval
+        self.shape, self.dtype, self.name = tuple(data.shape) + (3,), np.dtype(np.uint8), getattr(data, 'name', None)
+        self.attrs = {}
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[()], dtype)
+
+    def __getitem__(self, idx):
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        first, rest = (idx[0], idx[1:]) if idx and idx[0] is not Ellipsis else (slice(None), idx)
+        rows = np.arange(self.shape[0])[first] ; single = rows.ndim == 0
+        rows = np.atleast_1d(rows) ; keys = rows - rows % self.interval
+        need = np.union1d(rows, keys) # sorted, so it can index h5py datasets too
+        if len(need) == 0:
+            frames = np.empty((0,) + self.shape[1:], np.uint8)
+        else:
+            contiguous = need[-1] - need[0] + 1 == len(need)
+            data = np.asarray(self.data[need[0]:need[-1]+1] if contiguous else self.data[need])
+            at = lambda r: data[r - need[0]] if contiguous else data[np.searchsorted(need, r)]
+            frames = self.palette[at(rows) ^ np.where((rows == keys)[:, None, None], 0, at(keys))]
+        if single: frames = frames[0]
+        elif rest and rest[0] is not Ellipsis: rest = (slice(None),) + rest
+        return frames[rest] if rest else frames
+
+class FrameEncoder():
+    # streaming encoder for frame-like datasets: encode() turns the next (n,H,W,3) uint8 frames into (n,H,W) palette
+    # indices, every interval-th frame a keyframe and the others XORed with their keyframe. the palette only grows
+    def __init__(self, interval=keyframe_interval):
+        self.interval, self.palette, self.key, self.frames = interval, np.zeros((0, 3), np.uint8), None, 0
+
+    def encode(self, frames):
+        self.palette = frame_palette(frames, self.palette)
+        ix = palette_indices(frames, self.palette)
+        for j in range(len(ix)):
+            if (self.frames + j) % self.interval == 0: self.key = ix[j].copy()
+            else: ix[j] ^= self.key
+        self.frames += len(ix)
+        return ix
+
+    def finish(self, group, name):
+        # marks group/name as encoded and writes the palette next to it
+        group[name].attrs['codec'], group[name].attrs['keyframe_interval'] = 'palette-xor', self.interval
+        if name + '_palette' in group: del group[name + '_palette']
+        create_dataset(group, name + '_palette', self.palette, 'none')
+
+def encode_frames(frames, group, name='ins', interval=keyframe_interval, compression='lzf', block=256):
+    # writes the (T,H,W,3) uint8 frames (any sliceable) to group/name with a FrameEncoder, block frames at a time.
+    # returns (raw bytes, bytes on disk), or None, writing nothing, if the frames have too many colors
+    shape = tuple(frames.shape[:3]) ; encoder = FrameEncoder(interval)
+    ds = group.create_dataset(name, shape=shape, dtype=np.uint8, **dataset_layout(shape, np.uint8, compression))
+    try:
+        for i in range(0, shape[0], block):
+            ds[i:i+block] = encoder.encode(frames[i:i+block])
+    except ValueError as e:
+        print('{}: {}, keeping them raw'.format(ds.name, e))
+        del group[name] ; return None
+    encoder.finish(group, name)
+    return frames.dtype.itemsize * int(np.prod(frames.shape)), ds.id.get_storage_size() + group[name + '_palette'].id.get_storage_size()
+
+#====================== Manifest: JSON catalog of the runs, checkpoints and episodes of a store ======================#
+# written next to the store, so readers (the dashboard) learn its layout from one small file instead of walking the tree
+
+default_strides = {'ins': 5, 'actor_sal': 5, 'critic_sal': 5} # for stores written before strides were recorded
+
+def manifest_path(store_path):
+    # a store and its .npy export share one manifest: static/x.h5 and static/x/ both use static/x.manifest.json
+    return os.path.splitext(store_path.rstrip('/'))[0] + '.manifest.json'
+
+def episode_entry(history):
+    datasets = {}
+    for k in history.keys():
+        ds = history[k]
+        if isinstance(ds, h5py.Group) or k.endswith(('_scale', '_offset', '_palette')): continue # companions of encoded data
+        entry = {'shape': list(ds.shape), 'dtype': str(ds.dtype), 'stride': int(ds.attrs.get('stride', default_strides.get(k, 1)))}
+        if 'quantized' in ds.attrs: entry.update(quantized=str(ds.attrs['quantized']), dtype='float32')
+        if 'codec' in ds.attrs: entry.update(codec=str(ds.attrs['codec']), shape=list(ds.shape) + [3])
+        datasets[k] = entry # shape and dtype as read, i.e. after decoding
+    stats = {'frames': int(history['reward'].shape[0]) if 'reward' in history else 0}
+    if 'reward' in history: stats['total_reward'] = float(np.sum(history['reward'][()]))
+    if 'aggregates' in history:
+        for k in ['actor_tot', 'critic_tot']:
+            if k in history['aggregates']: stats[k + '_mean'] = float(np.mean(history['aggregates'][k][()]))
+    return {'path': history.name.lstrip('/'), 'partial': bool(history.attrs.get('partial', False)), 'datasets': datasets,
+            'features': sorted(k for k in history.keys() if isinstance(history[k], h5py.Group)), 'stats': stats}
+
+def build_manifest(store, name=None):
+    # runs are the top-level groups, checkpoints their model.<iteration>.tar groups (keyed by iteration), and
+    # episodes the groups under each checkpoint's history
+    runs = {}
+    for run in store.keys():
+        if not isinstance(store[run], h5py.Group): continue
+        checkpoints = {}
+        for ck in store[run].keys():
+            parts, group = ck.split('.'), store[run][ck]
+            if len(parts) != 3 or not parts[1].isdigit() or not isinstance(group, h5py.Group) or 'history' not in group: continue
+            checkpoints[parts[1]] = {'path': group.name.lstrip('/'),
+                                     'episodes': {ep: episode_entry(group['history'][ep]) for ep in group['history'].keys()}}
+        if checkpoints: runs[run] = {'checkpoints': checkpoints}
+    return {'version': 1, 'store': name, 'runs': runs}
+
+def write_manifest(store_path, dst_path=None):
+    # (re)writes the manifest of an h5 store, to manifest_path(store_path) unless dst_path is given
+    dst_path = manifest_path(store_path) if dst_path is None else dst_path
+    with h5py.File(store_path, 'r') as store:
+        manifest = build_manifest(store, os.path.basename(store_path))
+    with open(dst_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(dst_path + '.tmp', dst_path)
+    return manifest
+
+def load_manifest(store_path):
+    # manifest of a store (h5 file or .npy export), built from the h5 file if it was never written
+    if os.path.exists(manifest_path(store_path)):
+        with open(manifest_path(store_path)) as f:
+            return json.load(f)
+    print('no manifest for {}, reading its layout (write one with store.py manifest)'.format(store_path))
+    with h5py.File(store_path, 'r') as store:
+        return build_manifest(store, os.path.basename(store_path))
+
+def store_size(path):
+    return os.path.getsize(path) / 1e6 # MB
+
+def repack(src_path, dst_path, compression='lzf', quantization='none', encode=False, block=256):
+    # copy every group, dataset and attribute of src into a new store with the chunked/compressed layout,
+    # block frames at a time so stores larger than memory can be converted. with quantization, unquantized
+    # actor_sal/critic_sal are quantized on the way, and with encode, raw ins frames are palette/delta encoded
+    reports, encoded = [], []
+    with h5py.File(src_path, 'r') as src, h5py.File(dst_path, 'w') as dst:
+        dst.attrs.update(src.attrs)
+        def copy(name, obj):
+            if isinstance(obj, h5py.Group):
+                dst.require_group(name).attrs.update(obj.attrs)
+                return
+            if obj.shape == ():
+                dst.create_dataset(name, data=obj[()]) ; return
+            key = name.split('/')[-1]
+            parent = dst[name.rpartition('/')[0]] if '/' in name else dst
+            if encode and key == 'ins' and obj.ndim == 4 and obj.dtype == np.uint8 and 'codec' not in obj.attrs:
+                sizes = encode_frames(obj, parent, key, compression=compression, block=block)
+                if sizes is not None:
+                    for k, v in obj.attrs.items(): parent[key].attrs.setdefault(k, v)
+                    encoded.append(sizes) ; return
+            if quantization != 'none' and key in ['actor_sal', 'critic_sal'] and 'quantized' not in obj.attrs:
+                group, T = parent, obj.shape[0]
+                ds = group.create_dataset(key, shape=obj.shape, dtype=quantization,
+                                          **dataset_layout(obj.shape, quantization, compression))
+                ds.attrs.update(obj.attrs) ; ds.attrs['quantized'] = quantization
+                scale_ds, offset_ds = [group.create_dataset(key + k, shape=(T,), dtype=np.float32,
+                                                            **dataset_layout((T,), np.float32, compression)) for k in ['_scale', '_offset']]
+                for i in range(0, T, block):
+                    frames = obj[i:i+block]
+                    ds[i:i+block], scale_ds[i:i+block], offset_ds[i:i+block] = q, scale, offset = quantize(frames, quantization)
+                    reports.append(quantize_report(frames, q, scale, offset))
+                return
+            ds = dst.create_dataset(name, shape=obj.shape, dtype=obj.dtype, **dataset_layout(obj.shape, obj.dtype, compression))
+            for i in range(0, obj.shape[0], block):
+                ds[i:i+block] = obj[i:i+block]
+            ds.attrs.update(obj.attrs)
+        src.visititems(copy)
+    print('repacked {} ({:.1f} MB) into {} ({:.1f} MB, {})'.format(src_path, store_size(src_path), dst_path,
+                                                                  store_size(dst_path), compression))
+    if reports:
+        print('quantized saliency to {}: {}'.format(quantization, format_report(merge_reports(reports))))
+    if encoded:
+        print('encoded frames: {}'.format(format_frames_report(encoded)))
+    write_manifest(dst_path)
+
+def format_frames_report(sizes):
+    raw, stored = [sum(s) for s in zip(*sizes)]
+    return '{:.1f} MB raw -> {:.1f} MB on disk ({:.1f}x)'.format(raw / 1e6, stored / 1e6, raw / max(stored, 1))
+
+def _jsonable(attrs):
+    return {k: (v.tolist() if isinstance(v, (np.ndarray, np.generic)) else v) for k, v in attrs.items()}
+
+def export_stamp(src_path):
+    # identifies the version of a store an export was made from: rewriting the store (generate_data.py --overwrite,
+    # repack) changes its mtime, even when every dataset keeps its shape
+    st = os.stat(src_path)
+    return {'src': os.path.abspath(src_path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+def read_export_stamp(dst_dir):
+    try:
+        with open(os.path.join(dst_dir, 'export.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def export_current(src_path, dst_dir):
+    # whether dst_dir holds a complete export of the store as it is now
+    return read_export_stamp(dst_dir) == export_stamp(src_path)
+
+def export_npy(src_path, dst_dir, block=256):
+    # export every dataset of an h5 store to dst_dir/<dataset path>.npy, for memory-mapping (access.py:MmapStore).
+    # attributes go to dst_dir/attrs.json. the export is written to dst_dir.partial and then swapped in for dst_dir,
+    # so readers never see a mix of versions. an interrupted export resumes there if the store has not changed since,
+    # files being written under a temporary name first. an export that is current is left alone
+    stamp = export_stamp(src_path)
+    if read_export_stamp(dst_dir) == stamp:
+        print('{} is up to date with {}'.format(dst_dir, src_path)) ; return
+    staging = dst_dir.rstrip('/') + '.partial'
+    if read_export_stamp(staging) != stamp: # started from another version of the store, or never
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        with open(os.path.join(staging, 'export.json'), 'w') as f:
+            json.dump(stamp, f)
+    attrs = {}
+    with h5py.File(src_path, 'r') as src:
+        attrs['/'] = _jsonable(src.attrs)
+        def export(name, obj):
+            attrs['/' + name] = _jsonable(obj.attrs)
+            path = os.path.join(staging, name)
+            if isinstance(obj, h5py.Group):
+                os.makedirs(path, exist_ok=True) ; return
+            if os.path.exists(path + '.npy'): return # exported from this version before an interruption
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            out = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=obj.dtype, shape=obj.shape)
+            if obj.shape == (): out[()] = obj[()]
+            for i in range(0, obj.shape[0] if obj.shape else 0, block):
+                out[i:i+block] = obj[i:i+block]
+            out.flush() ; del out
+            os.replace(path + '.tmp', path + '.npy')
+        src.visititems(export)
+    with open(os.path.join(staging, 'attrs.json'), 'w') as f:
+        json.dump(attrs, f)
+    # swap in the new export. processes still serving the old one keep their memory maps of its (deleted) files
+    old = dst_dir.rstrip('/') + '.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.exists(dst_dir): os.rename(dst_dir, old)
+    os.rename(staging, dst_dir)
+    shutil.rmtree(old, ignore_errors=True)
+    write_manifest(src_path, manifest_path(dst_dir)) # same layout as the source, read through the export
+    print('exported {} ({:.1f} MB) to {}'.format(src_path, store_size(src_path), dst_dir))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='maintenance tools for h5 rollout stores')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('repack', help='rewrite a store with per-frame chunks and compression')
+    p.add_argument('src', type=str, help='store to read')
+    p.add_argument('dst', type=str, help='store to write')
+    p.add_argument('-c', '--compression', default='lzf', choices=sorted(compressors), help='compression filter')
+    p.add_argument('-q', '--quantize', default='none', choices=['none'] + sorted(quant_levels),
+                   help='also quantize saliency maps to this type (per-frame scale and offset)')
+    p.add_argument('-f', '--encode_frames', default=False, action='store_true',
+                   help='also store frames palette-indexed and XORed against keyframes')
+    p = commands.add_parser('export', help='export a store to uncompressed .npy files that the dashboard can memory-map')
+    p.add_argument('src', type=str, help='store to read')
+    p.add_argument('dst', type=str, help='directory to write')
+    p = commands.add_parser('manifest', help='(re)write the JSON manifest the dashboard reads the layout of a store from')
+    p.add_argument('src', type=str, help='store to read')
+    args = parser.parse_args()
+
+    if args.command == 'repack':
+        repack(args.src, args.dst, args.compression, args.quantize, args.encode_frames)
+    elif args.command == 'export':
+        export_npy(args.src, args.dst)
+    elif args.command == 'manifest':
+        write_manifest(args.src)
+        print('wrote', manifest_path(args.src))
+    else:
+        parser.print_help()